@@ -0,0 +1,747 @@
+# python 2 only
+import bisect
+import gc
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import timeit
+
+from binary_tree import BinaryTree, ConcurrentBinaryTree, IntervalTree, MultisetTree, PersistentBinaryTree, ShardedBinaryTree, \
+    SlidingWindowTree, TopKTree, TreeMap
+
+try:
+    from sortedcontainers import SortedSet
+except ImportError:
+    SortedSet = None
+
+
+def time_it(function, *args):
+    """ Return (Seconds Taken, Result) For A Single Call
+    """
+    gc.collect()
+    start = timeit.default_timer()
+    result = function(*args)
+    return timeit.default_timer() - start, result
+
+
+def insert_all(values):
+    tree = BinaryTree()
+    for value in values:
+        tree.insert(value)
+    return tree
+
+
+def benchmark_bulk_load(count):
+    values = [random.randint(0, count * 4) for _ in range(count)]
+    sorted_values = sorted(set(values))
+
+    insert_seconds, _ = time_it(insert_all, values)
+    unsorted_seconds, _ = time_it(BinaryTree, values)
+    sorted_seconds, _ = time_it(BinaryTree.from_sorted, sorted_values)
+
+    print("bulk load, %d elements" % count)
+    print("  repeated insert:       %8.3fs" % insert_seconds)
+    print("  BinaryTree(unsorted):  %8.3fs  (%.1fx)" % (unsorted_seconds, insert_seconds / unsorted_seconds))
+    print("  from_sorted(sorted):   %8.3fs  (%.1fx)" % (sorted_seconds, insert_seconds / sorted_seconds))
+
+
+def benchmark_insert_find(count, max_value):
+    """ The Workload From binary_tree.test(): count Random Inserts, Then As Many Finds
+    """
+    values = [random.randint(0, max_value) for _ in range(count)]
+    insert_seconds, tree = time_it(insert_all, values)
+    find_seconds, _ = time_it(lambda: [tree.find(value) for value in values])
+
+    print("insert/find, %d values in [0, %d]" % (count, max_value))
+    print("  insert: %8.3fs  (%.2fus per insert)" % (insert_seconds, insert_seconds * 1e6 / count))
+    print("  find:   %8.3fs  (%.2fus per find)" % (find_seconds, find_seconds * 1e6 / count))
+
+
+def benchmark_retrace(count):
+    """ Report Nodes Visited By Retracing And Rotations Per Operation, And What Collecting Stats Costs
+    """
+    print("retracing, %d elements" % count)
+    for label, values in (("random", [random.random() for _ in range(count)]), ("sorted", list(range(count)))):
+        plain_seconds, _ = time_it(insert_all, values)
+        tree = BinaryTree()
+        tree.enable_stats()
+        stats_seconds, _ = time_it(lambda: [tree.insert(value) for value in values])
+        stats = tree.stats()
+        print("  %s insert: %.2f nodes retraced, %.2f rotations per insert (stats on: %.2fus, off: %.2fus)" %
+              (label, float(stats["retrace_steps"]) / count, float(stats["rotations"]) / count,
+               stats_seconds * 1e6 / count, plain_seconds * 1e6 / count))
+        tree.reset_stats()
+        removed = values[:count // 2]
+        seconds, _ = time_it(lambda: [tree.remove(value) for value in removed])
+        stats = tree.stats()
+        print("  %s remove: %.2f nodes retraced, %.2f rotations per remove (%.2fus per remove)" %
+              (label, float(stats["retrace_steps"]) / len(removed), float(stats["rotations"]) / len(removed),
+               seconds * 1e6 / len(removed)))
+        print("    " + tree.stats_report().replace("\n", "\n    "))
+
+
+def benchmark_order_statistics(count, queries=1000):
+    tree = BinaryTree(random.random() for _ in range(count))
+    percents = [random.uniform(0, 100) for _ in range(queries)]
+    select_seconds, _ = time_it(lambda: [tree.percentile(p) for p in percents])
+    list_seconds, _ = time_it(lambda: [tree.as_list(1)[int(p / 100 * (len(tree) - 1))] for p in percents[:10]])
+
+    print("order statistics, %d elements" % count)
+    print("  percentile():          %8.2fus per query" % (select_seconds * 1e6 / queries))
+    print("  as_list() and index:   %8.2fus per query" % (list_seconds * 1e6 / 10))
+
+
+def benchmark_iteration(count, take=300):
+    tree = BinaryTree(random.random() for _ in range(count))
+    lazy_seconds, _ = time_it(lambda: list(itertools.islice(tree.irange(0.5), take)))
+    list_seconds, _ = time_it(lambda: [v for v in tree.as_list(1) if v >= 0.5][:take])
+    full_seconds, _ = time_it(lambda: sum(1 for _ in tree))
+
+    print("iteration, %d elements" % count)
+    print("  first %d >= 0.5 via irange:   %8.2fms" % (take, lazy_seconds * 1e3))
+    print("  first %d >= 0.5 via as_list:  %8.2fms" % (take, list_seconds * 1e3))
+    print("  full lazy iteration:          %8.2fms" % (full_seconds * 1e3))
+
+
+def benchmark_batches(count):
+    base = [random.random() for _ in range(count)]
+    print("batched insert into %d elements" % count)
+    for batch_count in (count // 100, count // 10, count):
+        batch = [random.random() for _ in range(batch_count)]
+        tree = BinaryTree(base)
+        loop_seconds, _ = time_it(lambda: [tree.insert(value) for value in batch])
+        tree = BinaryTree(base)
+        batch_seconds, _ = time_it(tree.insert_many, batch)
+        print("  %8d values: insert loop %8.3fs, insert_many %8.3fs (%.1fx)" %
+              (batch_count, loop_seconds, batch_seconds, loop_seconds / batch_seconds))
+
+
+def benchmark_split_join(count, repeats=100):
+    tree = BinaryTree(range(count))
+    pivots = [random.randint(0, count) for _ in range(repeats)]
+
+    def split_and_join():
+        result = tree
+        for pivot in pivots:
+            less, greater = result.split(pivot)
+            result = BinaryTree.join(less, greater)
+        return result
+
+    split_join_seconds, tree = time_it(split_and_join)
+    rebuild_seconds, _ = time_it(lambda: [(BinaryTree([v for v in tree.as_list(1) if v < pivot]),
+                                           BinaryTree([v for v in tree.as_list(1) if v >= pivot])) for pivot in pivots[:3]])
+
+    print("split and join, %d elements" % count)
+    print("  split() + join():          %8.2fus per pair" % (split_join_seconds * 1e6 / repeats))
+    print("  as_list() and two rebuilds: %8.2fus per pair" % (rebuild_seconds * 1e6 / 3))
+
+
+def benchmark_finger(count):
+    monotone = list(range(count))
+    near_sorted = [i + random.randint(-20, 20) for i in range(count)]
+    print("finger insert, %d elements" % count)
+    for label, values in (("monotone", monotone), ("near-sorted", near_sorted)):
+        insert_seconds, _ = time_it(insert_all, values)
+        tree = BinaryTree()
+        finger_seconds, _ = time_it(lambda: [tree.finger_insert(value) for value in values])
+        print("  %-12s insert %8.3fs, finger_insert %8.3fs (%.1fx)" %
+              (label, insert_seconds, finger_seconds, insert_seconds / finger_seconds))
+
+
+def benchmark_snapshot(count, queries=1000):
+    values = [random.random() for _ in range(count)]
+    tree = BinaryTree(values)
+    path = tempfile.mktemp()
+    try:
+        save_seconds, _ = time_it(tree.save, path)
+        del tree
+        # drop each built tree outside the timed calls, freeing a million nodes takes a while
+        rebuild_seconds, built = time_it(BinaryTree, values)
+        del built
+        load_seconds, built = time_it(BinaryTree.load, path, False)
+        del built
+        mapped_seconds, mapped = time_it(BinaryTree.load, path)
+        queries = min(queries, count)
+        probes = random.sample(values, queries)
+        find_seconds, _ = time_it(lambda: [mapped.find(value) for value in probes])
+        rank_seconds, _ = time_it(lambda: [mapped.rank(value) for value in probes])
+
+        print("snapshot, %d elements, %.1f bytes per element on disk" % (count, float(os.path.getsize(path)) / count))
+        print("  save:                   %8.3fs" % save_seconds)
+        print("  rebuild from values:    %8.3fs" % rebuild_seconds)
+        print("  load(mmap=False):       %8.3fs" % load_seconds)
+        print("  load(mmap=True):        %8.3fms" % (mapped_seconds * 1e3))
+        print("  mapped find / rank:     %8.2fus / %.2fus" % (find_seconds * 1e6 / queries, rank_seconds * 1e6 / queries))
+        mapped.materialize()
+    finally:
+        os.remove(path)
+
+
+class LockedBinaryTree(object):
+    """ The Baseline For benchmark_concurrency: A BinaryTree Behind One Global Lock
+    """
+    def __init__(self, values):
+        self.tree = BinaryTree(values)
+        self.lock = threading.Lock()
+
+    def insert(self, value):
+        with self.lock:
+            self.tree.insert(value)
+
+    def find(self, value):
+        with self.lock:
+            return self.tree.find(value)
+
+    def irange(self, low, high):
+        with self.lock:
+            return list(self.tree.irange(low, high))
+
+
+def run_threads(tree, readers, probes, writes):
+    """ Run readers Threads Doing Finds And Short Scans Alongside One Writer
+    Returns (Seconds Until The Readers Finished, Seconds Until The Writer Finished)
+    """
+    finished = {}
+
+    def read():
+        for value in probes:
+            tree.find(value)
+            list(tree.irange(value, value + 0.0001))
+        finished["read"] = timeit.default_timer()
+
+    def write():
+        for value in writes:
+            tree.insert(value)
+        finished["write"] = timeit.default_timer()
+
+    threads = [threading.Thread(target=read) for _ in range(readers)] + [threading.Thread(target=write)]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return finished["read"] - start, finished["write"] - start
+
+
+def benchmark_concurrency(count, reads=20000, writes=5000):
+    values = [random.random() for _ in range(count)]
+    reads = min(reads, count)
+    probes = random.sample(values, reads)
+    print("concurrent readers with one writer, %d elements, %d reads and %d writes" % (count, reads, writes))
+    for readers in (1, 4, 16):
+        for tree_class in (LockedBinaryTree, ConcurrentBinaryTree):
+            tree = tree_class(values)
+            per_reader = probes[:max(1, reads // readers)]
+            read_seconds, write_seconds = run_threads(tree, readers, per_reader,
+                                                      [random.random() for _ in range(writes)])
+            print("  %2d readers, %-20s %9.0f reads/s, writer done in %6.3fs" %
+                  (readers, tree_class.__name__ + ":", readers * len(per_reader) / read_seconds, write_seconds))
+
+
+def node_bytes(tree):
+    """ Return Bytes Held By The Tree's Node Objects (Excluding The Values And Names Themselves)
+    """
+    total = 0
+    stack = [tree.root] if tree.root is not None else []
+    while stack:
+        node = stack.pop()
+        total += sys.getsizeof(node)
+        if hasattr(node, "__dict__"):
+            total += sys.getsizeof(node.__dict__)
+        for child in (node.left_child, node.right_child):
+            if child is not None:
+                stack.append(child)
+    return total
+
+
+def new_node_bytes(old_root, new_root):
+    """ Return Bytes Of The Nodes In new_root's Version That It Does Not Share With old_root's
+    """
+    shared = set()
+    stack = [old_root] if old_root is not None else []
+    while stack:
+        node = stack.pop()
+        shared.add(id(node))
+        stack.extend(child for child in (node.left_child, node.right_child) if child is not None)
+    total = 0
+    stack = [new_root] if new_root is not None else []
+    while stack:
+        node = stack.pop()
+        if id(node) not in shared:
+            total += sys.getsizeof(node)
+            stack.extend(child for child in (node.left_child, node.right_child) if child is not None)
+    return total
+
+
+def benchmark_persistence(count, updates=1000):
+    values = [random.random() for _ in range(count)]
+    tree = PersistentBinaryTree(values)
+    snapshot_seconds, _ = time_it(lambda: [tree.snapshot() for _ in range(updates)])
+    list_seconds, _ = time_it(lambda: [tree.as_list() for _ in range(3)])
+
+    versions = [tree.snapshot()]
+    removed = random.sample(values, min(updates // 2, count))
+    for value in removed:
+        tree.remove(value)
+        versions.append(tree.snapshot())
+    for _ in range(updates - len(removed)):
+        tree.insert(random.random())
+        versions.append(tree.snapshot())
+    growth = [new_node_bytes(old.root, new.root) for old, new in zip(versions[:100], versions[1:101])]
+    growth += [new_node_bytes(old.root, new.root) for old, new in zip(versions[-101:-1], versions[-100:])]
+    probes = random.sample(values, min(updates, count))
+    find_seconds, _ = time_it(lambda: [versions[0].find(value) for value in probes])
+
+    print("persistent versions, %d elements" % count)
+    print("  snapshot():             %8.2fus" % (snapshot_seconds * 1e6 / updates))
+    print("  as_list() copy:         %8.2fms" % (list_seconds * 1e3 / 3))
+    print("  bytes added per update: %8.1f (remove and insert, %d nodes per version)" %
+          (float(sum(growth)) / len(growth), len(tree)))
+    print("  find in oldest of %d versions: %.2fus" % (len(versions), find_seconds * 1e6 / len(probes)))
+
+
+def benchmark_tree_map(count):
+    """ TreeMap Against The dict Plus BinaryTree Pair It Replaces
+    """
+    keys = [random.random() for _ in range(count)]
+
+    def fill_pair():
+        tree, payloads = BinaryTree(), {}
+        for k in keys:
+            tree.insert(k)
+            payloads[k] = k
+        return tree, payloads
+
+    def fill_map():
+        tree_map = TreeMap()
+        for k in keys:
+            tree_map[k] = k
+        return tree_map
+
+    pair_seconds, (tree, payloads) = time_it(fill_pair)
+    pair_get_seconds, _ = time_it(lambda: [payloads[k] for k in keys if tree.find(k) is not None])
+    pair_bytes = node_bytes(tree) + sys.getsizeof(payloads)
+    # measure each structure alone, live objects slow the cyclic collector down
+    tree = payloads = None
+    map_seconds, tree_map = time_it(fill_map)
+    map_get_seconds, _ = time_it(lambda: [tree_map[k] for k in keys])
+
+    print("tree map, %d entries" % count)
+    print("  dict + BinaryTree: set %6.2fus, get %6.2fus, %6.1f bytes per entry" %
+          (pair_seconds * 1e6 / count, pair_get_seconds * 1e6 / count, float(pair_bytes) / count))
+    print("  TreeMap:           set %6.2fus, get %6.2fus, %6.1f bytes per entry" %
+          (map_seconds * 1e6 / count, map_get_seconds * 1e6 / count, float(node_bytes(tree_map)) / count))
+
+
+def benchmark_multiset(count, distinct=5000):
+    """ MultisetTree Against One Named Node Per Occurrence, On Many Repeats Of Few Values
+    """
+    values = [random.randint(0, distinct) for _ in range(count)]
+
+    def insert_named():
+        tree = BinaryTree()
+        for i in range(len(values)):
+            tree.insert(values[i], i)
+        return tree
+
+    def add_all():
+        tree = MultisetTree()
+        for value in values:
+            tree.add(value)
+        return tree
+
+    named_seconds, named = time_it(insert_named)
+    named_bytes = node_bytes(named)
+    named = None
+    multiset_seconds, multiset = time_it(add_all)
+
+    print("multiset, %d occurrences of %d values" % (count, distinct))
+    print("  named nodes:   %8.3fs, %8.1f node bytes per occurrence" % (named_seconds, float(named_bytes) / count))
+    print("  MultisetTree:  %8.3fs, %8.1f node bytes per occurrence" %
+          (multiset_seconds, float(node_bytes(multiset)) / count))
+
+
+def engine_bytes(tree):
+    if hasattr(tree, "leaves"):
+        return sys.getsizeof(tree.leaves) + sum(sys.getsizeof(leaf) + sum(sys.getsizeof(entry) for entry in leaf)
+                                                for leaf in tree.leaves)
+    return node_bytes(tree)
+
+
+def benchmark_engines(count, queries=100000):
+    """ The Numbers Behind The README's Engine Guide
+    """
+    values = [random.random() for _ in range(count)]
+    probes = [random.choice(values) for _ in range(queries)]
+    print("engines, %d elements" % count)
+    for engine in ("avl", "btree"):
+        build_seconds, tree = time_it(BinaryTree, values, None, engine)
+        tree_bytes = engine_bytes(tree)
+        tree = BinaryTree(engine=engine)
+        insert_seconds, _ = time_it(lambda: [tree.insert(value) for value in values])
+        find_seconds, _ = time_it(lambda: [tree.find(value) for value in probes])
+        min_max_seconds, _ = time_it(lambda: [(tree.get_min(), tree.get_max()) for _ in range(1000)])
+        iterate_seconds, _ = time_it(lambda: sum(1 for _ in tree))
+        range_seconds, _ = time_it(lambda: [list(itertools.islice(tree.irange(value), 10)) for value in probes[:10000]])
+        remove_seconds, _ = time_it(lambda: [tree.remove(value) for value in probes])
+        print("  %-5s build %6.3fs, insert %5.2fus, find %5.2fus, remove %5.2fus, min+max %5.2fus, "
+              "10 from irange %5.2fus, iterate %6.3fs, %5.1f bytes per element" %
+              (engine, build_seconds, insert_seconds * 1e6 / count, find_seconds * 1e6 / queries,
+               remove_seconds * 1e6 / queries, min_max_seconds * 1e3, range_seconds * 1e6 / 10000, iterate_seconds,
+               float(tree_bytes) / count))
+
+
+def benchmark_aggregates(count, queries=1000):
+    values = [random.random() for _ in range(count)]
+    windows = [sorted((random.random(), random.random())) for _ in range(queries)]
+    plain_seconds, _ = time_it(insert_all, values)
+    tree = BinaryTree(aggregate="sum")
+    insert_seconds, _ = time_it(lambda: [tree.insert(value) for value in values])
+    range_seconds, _ = time_it(lambda: [tree.aggregate_range(low, high) for low, high in windows])
+    list_seconds, _ = time_it(lambda: [sum(v for v in tree.as_list(1) if low <= v <= high) for low, high in windows[:3]])
+
+    print("range aggregates, %d elements" % count)
+    print("  insert with a sum aggregate %6.2fus, without %6.2fus" %
+          (insert_seconds * 1e6 / count, plain_seconds * 1e6 / count))
+    print("  aggregate_range():          %8.2fus per query" % (range_seconds * 1e6 / queries))
+    print("  as_list() and sum:          %8.2fus per query" % (list_seconds * 1e6 / 3))
+
+
+def benchmark_intervals(count, queries=100):
+    """ Overlap Queries On count Intervals Of Up To 1/1000 Of The Span, Against A Linear Scan
+    """
+    intervals = []
+    for _ in range(count):
+        start = random.random()
+        intervals.append((start, start + random.random() / 1000))
+    windows = [(low, low + 0.0001) for low in (random.random() for _ in range(queries))]
+    build_seconds, tree = time_it(IntervalTree, intervals)
+    tree_seconds, found = time_it(lambda: [list(tree.overlapping(low, high)) for low, high in windows])
+    scan_seconds, _ = time_it(lambda: [[iv for iv in intervals if iv[0] <= high and iv[1] >= low]
+                                       for low, high in windows[:5]])
+
+    print("interval overlaps, %d intervals, %.0f matches per query" % (count, float(sum(map(len, found))) / queries))
+    print("  IntervalTree build:  %8.3fs" % build_seconds)
+    print("  overlapping():       %8.2fms per query" % (tree_seconds * 1e3 / queries))
+    print("  linear scan:         %8.2fms per query" % (scan_seconds * 1e3 / 5))
+
+
+def benchmark_nearest(count, queries=10000):
+    tree = BinaryTree(random.random() for _ in range(count))
+    probes = [random.random() for _ in range(queries)]
+    floor_seconds, _ = time_it(lambda: [tree.floor(p) for p in probes])
+    nearest_seconds, _ = time_it(lambda: [tree.nearest(p) for p in probes])
+    k_nearest_seconds, _ = time_it(lambda: [tree.k_nearest(p, 10) for p in probes])
+    list_seconds, _ = time_it(lambda: [tree.as_list(1)[bisect.bisect_right(tree.as_list(1), p) - 1] for p in probes[:3]])
+
+    print("nearest keys, %d elements" % count)
+    print("  floor():              %8.2fus" % (floor_seconds * 1e6 / queries))
+    print("  nearest():            %8.2fus" % (nearest_seconds * 1e6 / queries))
+    print("  k_nearest(k=10):      %8.2fus" % (k_nearest_seconds * 1e6 / queries))
+    print("  as_list() and bisect: %8.2fus" % (list_seconds * 1e6 / 3))
+
+
+def benchmark_priority_queue(count):
+    values = [random.random() for _ in range(count)]
+    pushes = [random.random() for _ in range(count)]
+
+    def tree_queue():
+        tree = BinaryTree()
+        for value in values:
+            tree.insert(value)
+        for value in pushes:
+            tree.pushpop(value)
+        while len(tree):
+            tree.pop_min()
+
+    def heap_queue():
+        heap = []
+        for value in values:
+            heapq.heappush(heap, value)
+        for value in pushes:
+            heapq.heappushpop(heap, value)
+        while heap:
+            heapq.heappop(heap)
+
+    tree = BinaryTree(values)
+    peek_seconds, _ = time_it(lambda: [tree.peek_min() for _ in range(count)])
+    pop_seconds, _ = time_it(lambda: [tree.pop_min() for _ in range(count // 2)])
+    remove_seconds, _ = time_it(lambda: [tree.remove(tree.get_min()) for _ in range(count // 2)])
+    tree = None
+    tree_seconds, _ = time_it(tree_queue)
+    heap_seconds, _ = time_it(heap_queue)
+
+    print("priority queue, %d pushes, pushpops and pops" % count)
+    print("  BinaryTree: %8.3fs (peek_min %.2fus)" % (tree_seconds, peek_seconds * 1e6 / count))
+    print("  heapq:      %8.3fs, min only" % heap_seconds)
+    print("  pop_min() %.2fus against remove(get_min()) %.2fus" %
+          (pop_seconds * 2e6 / count, remove_seconds * 2e6 / count))
+
+
+def benchmark_sharding(count, queries=100000):
+    """ ShardedBinaryTree At 1 To 16 Workers Against One In-Process Tree; Only Scales With Free Cores
+    """
+    values = [random.random() for _ in range(count)]
+    probes = [random.random() for _ in range(queries)]
+    print("sharding, %d elements, %d finds, 10 scans of 1/10 of the keys, %d cores" %
+          (count, queries, multiprocessing.cpu_count()))
+    load_seconds, tree = time_it(BinaryTree, values)
+    find_seconds, _ = time_it(lambda: [tree.find(value) is not None for value in probes])
+    scan_seconds, _ = time_it(lambda: [list(tree.irange(low, low + 0.1)) for low in probes[:10]])
+    tree = None
+    print("  single tree:  load %7.3fs, find batch %7.3fs, scans %7.3fs" % (load_seconds, find_seconds, scan_seconds))
+    for workers in (1, 2, 4, 8, 16):
+        sharded = ShardedBinaryTree(workers=workers)
+        try:
+            load_seconds, _ = time_it(sharded.load, values)
+            find_seconds, _ = time_it(sharded.find_many, probes)
+            scan_seconds, _ = time_it(lambda: [list(sharded.irange(low, low + 0.1)) for low in probes[:10]])
+        finally:
+            sharded.close()
+        print("  %2d workers:   load %7.3fs, find batch %7.3fs, scans %7.3fs" %
+              (workers, load_seconds, find_seconds, scan_seconds))
+
+
+def benchmark_top_k(count, capacity=10000):
+    """ Keeping The capacity Largest Of count Events: TopKTree Against insert + get_min + remove On A Plain
+    BinaryTree, And heapq.heappushpop, Which Keeps No Order
+    """
+    capacity = min(capacity, max(count // 10, 1))
+    events = [random.random() for _ in range(count)]
+    print("top %d of %d events" % (capacity, count))
+
+    def plain():
+        tree = BinaryTree()
+        for value in events:
+            if len(tree) < capacity:
+                tree.insert(value)
+            elif tree.get_min() < value:
+                tree.insert(value)
+                tree.remove(tree.get_min())
+        return tree
+
+    def heap():
+        kept = events[:capacity]
+        heapq.heapify(kept)
+        for value in events[capacity:]:
+            if kept[0] < value:
+                heapq.heappushpop(kept, value)
+        return kept
+
+    def top_k():
+        tree = TopKTree(capacity=capacity)
+        tree.insert_many(events)
+        return tree
+
+    for name, function in (("insert/get_min/remove", plain), ("heapq", heap), ("TopKTree", top_k)):
+        seconds, _ = time_it(function)
+        print("  %-22s %8.3fs, %6.2fM events/s" % (name, seconds, count / seconds / 1e6))
+    for skew, stream in (("ascending", sorted(events)), ("descending", sorted(events, reverse=True))):
+        seconds, _ = time_it(TopKTree(events[:1], capacity=capacity).insert_many, stream)
+        print("  TopKTree, %-11s  %8.3fs" % (skew, seconds))
+    board = top_k()
+    seconds, _ = time_it(lambda: list(itertools.islice(board.ranked(), 100)))
+    print("  best 100, lazily:      %8.2fus" % (seconds * 1e6))
+
+
+def benchmark_sliding_window(count, rate=1000000):
+    """ Sustained Events Per Second Into Count And Time Windows, Against The rate Target, And Window Query Times
+    Time windows are fed synthetic timestamps spaced 1/rate apart, so each holds one second of the stream
+    """
+    events = [random.random() for _ in range(count)]
+    stamped = [(index / float(rate), value) for index, value in enumerate(events)]
+    print("sliding window, %d events, target %d events/s" % (count, rate))
+    for size in (1000, 10000, 100000):
+        window = SlidingWindowTree(window_size=size)
+        add_seconds, _ = time_it(lambda: [window.add(value) for value in events])
+        window = SlidingWindowTree(window_size=size)
+        batch_seconds, _ = time_it(window.extend, events)
+        print("  last %6d:   add %9.0f events/s, extend %9.0f events/s" %
+              (size, count / add_seconds, count / batch_seconds))
+    window = SlidingWindowTree(window_seconds=1.0)
+    batch_seconds, _ = time_it(window.extend, stamped, True)
+    print("  last second:   extend %9.0f events/s (%.2fx target), %d in window" %
+          (count / batch_seconds, count / batch_seconds / rate, len(window)))
+    queries = 10000
+    for name, query in (("median", window.median), ("p99", lambda: window.quantile(0.99)),
+                        ("min", window.get_min), ("rank", lambda: window.rank(0.5))):
+        seconds, _ = time_it(lambda: [query() for _ in range(queries)])
+        print("  %-6s %8.2fus" % (name, seconds / queries * 1e6))
+
+
+def benchmark_memory(count):
+    tree = BinaryTree(range(count))
+    print("memory, %d elements" % count)
+    print("  node bytes per element: %8.1f" % (float(node_bytes(tree)) / len(tree)))
+
+
+class BisectList(object):
+    """ Sorted Python List Kept With bisect, The Baseline For The Suite
+    Duplicates are dropped, as BinaryTree does for unnamed values
+    """
+    def __init__(self):
+        self.values = []
+
+    def insert(self, value):
+        index = bisect.bisect_left(self.values, value)
+        if index == len(self.values) or self.values[index] != value:
+            self.values.insert(index, value)
+
+    def remove(self, value):
+        index = bisect.bisect_left(self.values, value)
+        if index < len(self.values) and self.values[index] == value:
+            del self.values[index]
+
+    def find(self, value):
+        index = bisect.bisect_left(self.values, value)
+        return index < len(self.values) and self.values[index] == value
+
+    def get_min(self):
+        return self.values[0]
+
+    def get_max(self):
+        return self.values[-1]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def memory(self):
+        return sys.getsizeof(self.values)
+
+
+class TreeSuiteAdapter(BinaryTree):
+    def memory(self):
+        return node_bytes(self)
+
+
+if SortedSet is not None:
+    class SortedSetAdapter(SortedSet):
+        insert = SortedSet.add
+        remove = SortedSet.discard
+        find = SortedSet.__contains__
+
+        def get_min(self):
+            return self[0]
+
+        def get_max(self):
+            return self[-1]
+
+        def memory(self):
+            lists = self._list._lists
+            return sys.getsizeof(self._set) + sys.getsizeof(lists) + sum(sys.getsizeof(chunk) for chunk in lists)
+
+SUITE_IMPLEMENTATIONS = [("BinaryTree", TreeSuiteAdapter), ("bisect_list", BisectList)]
+if SortedSet is not None:
+    SUITE_IMPLEMENTATIONS.append(("SortedSet", SortedSetAdapter))
+
+# inserting into a list is O(n), beyond this the baseline takes hours
+BISECT_LIMIT = 10 ** 6
+
+
+def suite_workloads(size):
+    """ Return [(Label, Values To Insert)] For The Suite
+    """
+    values = random.sample(range(size * 4), size)
+    return [("random", values),
+            ("sorted", sorted(values)),
+            ("reverse", sorted(values, reverse=True)),
+            ("duplicates", [random.randint(0, size // 100) for _ in range(size)])]
+
+
+def suite_run(make, values, queries=1000):
+    """ Time One Implementation On One Workload, Return {Operation: Seconds} And Bytes Per Element
+    """
+    results = {}
+    tree = make()
+    insert_seconds, _ = time_it(lambda: [tree.insert(value) for value in values])
+    results["insert"] = (insert_seconds, len(values))
+    results["find"] = (time_it(lambda: [tree.find(value) for value in values])[0], len(values))
+    results["min_max"] = (time_it(lambda: [(tree.get_min(), tree.get_max()) for _ in range(queries)])[0], queries)
+    results["traverse"] = (time_it(lambda: sum(1 for _ in tree))[0], 1)
+    count = sum(1 for _ in tree)
+    bytes_per_element = float(tree.memory()) / count
+
+    # interleaved deletes: remove one existing value, insert a new one
+    removed = random.sample(values, len(values) // 2)
+    added = [random.random() * len(values) for _ in removed]
+
+    def churn():
+        for old, new in zip(removed, added):
+            tree.remove(old)
+            tree.insert(new)
+
+    results["remove_insert"] = (time_it(churn)[0], len(removed))
+    return results, bytes_per_element
+
+
+def run_suite(args):
+    """ Usage: benchmark.py suite [SIZE ...] [--json PATH]
+    Times every implementation on every workload at each size and writes the results as JSON
+    """
+    path = None
+    if "--json" in args:
+        index = args.index("--json")
+        path = args[index + 1]
+        args = args[:index] + args[index + 2:]
+    sizes = [int(float(size)) for size in args] or [10 ** 3, 10 ** 4, 10 ** 5]
+    report = {"python": platform.python_version(), "platform": platform.platform(), "results": []}
+    for size in sizes:
+        for workload, values in suite_workloads(size):
+            for name, make in SUITE_IMPLEMENTATIONS:
+                if make is BisectList and size > BISECT_LIMIT:
+                    continue
+                results, bytes_per_element = suite_run(make, values)
+                for operation, (seconds, count) in sorted(results.items()):
+                    report["results"].append({"implementation": name, "workload": workload, "size": size,
+                                              "operation": operation, "seconds": seconds,
+                                              "us_per_op": seconds * 1e6 / count})
+                report["results"].append({"implementation": name, "workload": workload, "size": size,
+                                          "operation": "memory", "bytes_per_element": bytes_per_element})
+                print("%-11s %-10s %9d  insert %8.2fus  find %6.2fus  remove+insert %7.2fus  %6.1f bytes/element" %
+                      (name, workload, size, results["insert"][0] * 1e6 / results["insert"][1],
+                       results["find"][0] * 1e6 / results["find"][1],
+                       results["remove_insert"][0] * 1e6 / results["remove_insert"][1], bytes_per_element))
+    if path is not None:
+        with open(path, "w") as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+    return report
+
+
+def main(args):
+    if args and args[0] == "suite":
+        run_suite(args[1:])
+        return
+    count = int(args[0]) if args else 100000
+    benchmark_bulk_load(count)
+    benchmark_insert_find(20000, 25000)
+    benchmark_retrace(count)
+    benchmark_order_statistics(count)
+    benchmark_iteration(count)
+    benchmark_batches(count)
+    benchmark_split_join(count)
+    benchmark_finger(count)
+    benchmark_snapshot(count)
+    benchmark_concurrency(count)
+    benchmark_persistence(count)
+    benchmark_tree_map(count)
+    benchmark_multiset(count)
+    benchmark_engines(count)
+    benchmark_aggregates(count)
+    benchmark_intervals(count)
+    benchmark_nearest(count)
+    benchmark_priority_queue(count)
+    benchmark_sharding(count)
+    benchmark_top_k(count)
+    benchmark_sliding_window(count)
+    benchmark_memory(count)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
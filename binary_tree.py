@@ -1,9 +1,32 @@
 # python 2 only
+import bisect
+import collections
+import gc
+import heapq
+import itertools
 import random
 import math
+import mmap
+import multiprocessing
+import numbers
+import operator
+import os
+import struct
+import tempfile
+import threading
+import time
+import timeit
 
+SNAPSHOT_MAGIC = b"BTREESNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIQcc")  # magic, version, element count, value type, name type
+SNAPSHOT_HEADER_SIZE = 32  # header padded so the columns after it are 8-byte aligned
+SNAPSHOT_CHUNK = 4096  # elements packed or unpacked per struct call
+
+
+class NodeKey(object):
+    __slots__ = ('name', 'value')
 
-class NodeKey():
     def __init__(self, value, name=None):
         self.name = name
         self.value = value
@@ -33,18 +56,49 @@ class NodeKey():
             return str(self.value) + "," + str(self.name)
 
 
-class Node():
+class Node(object):
+    """ Tree Node, With The (value, name) Key Stored Directly On It
+    __slots__ keeps each node free of a per-instance __dict__
+    """
+    __slots__ = ('value', 'name', 'sort_key', 'parent', 'left_child', 'right_child', 'height', 'size')
+
     def __init__(self, value, name=None):
-        self.key = NodeKey(value, name)
         self.value = value
+        self.name = name
+        self.sort_key = value  # what the tree orders by, value unless the tree has a key function
         self.parent = None
         self.left_child = None
         self.right_child = None
         self.height = 0
+        self.size = 1  # number of nodes in the subtree rooted here
+
+    @property
+    def key(self):
+        return NodeKey(self.value, self.name)
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key or (self.sort_key == other.sort_key and self.name != other.name and
+                                                  self.name < other.name)
+
+    def __gt__(self, other):
+        return self.sort_key > other.sort_key or (self.sort_key == other.sort_key and self.name != other.name and
+                                                  self.name > other.name)
 
     def __str__(self):
         return str(self.key)
 
+    def compare(self, sort_key, name=None):
+        """ Three-Way Compare: Negative If (sort_key, name) Orders Before This Node, 0 If Equal, Else Positive
+        """
+        if sort_key < self.sort_key:
+            return -1
+        elif self.sort_key < sort_key:
+            return 1
+        elif name == self.name:
+            return 0
+        else:
+            return -1 if name < self.name else 1
+
     def next(self):
         """ Returns the next Node (next key value larger)
         """
@@ -123,13 +177,45 @@ class Node():
         balance = left_height - right_height
         return balance
 
+    def update_size(self):
+        """ Recompute Subtree Size Of This Node From Its Children
+        """
+        size = 1
+        if self.left_child is not None:
+            size += self.left_child.size
+        if self.right_child is not None:
+            size += self.right_child.size
+        self.size = size
+
+    def refresh(self):
+        """ Recompute Height And Subtree Size Of This Node From Its Children
+        """
+        left = self.left_child
+        right = self.right_child
+        if left is None:
+            if right is None:
+                self.height = 0
+                self.size = 1
+            else:
+                self.height = right.height + 1
+                self.size = right.size + 1
+        elif right is None:
+            self.height = left.height + 1
+            self.size = left.size + 1
+        else:
+            self.height = (left.height if left.height > right.height else right.height) + 1
+            self.size = left.size + right.size + 1
+
     def update_height(self):
         """ Updates Height of This Node and All Ancestor Nodes, As Necessary
+        Stops at the first node whose height is already correct, as no ancestor above it can change
         """
-        # TODO: should stop iterating when reaches correct height
         node = self
         while node is not None:
-            node.height = node.max_child_height() + 1
+            height = node.max_child_height() + 1
+            if node.height == height:
+                break
+            node.height = height
             node = node.parent
 
     def root(self):
@@ -139,27 +225,31 @@ class Node():
         return node
 
     def balance(self, tree):
-        """ Balances node, sets new tree root if appropriate
+        """ Balances node with one single or double rotation, sets new tree root if appropriate
+        Returns the node now at the top of this subtree; children must already be balanced
         Note: If balancing does occur, this node will move to a lower position on the tree
         """
-        while self.weigh() < -1 or self.weigh() > 1:
-            if self.weigh() < 0:
-                # right side heavy
-                if self.right_child.weigh() > 0:
-                    # right-side left-side heavy
-                    self.right_child.rotate_left()
-                # right-side right-side heavy
-                new_top = self.rotate_right()
-            else:
-                # left side heavy
-                if self.left_child.weigh() < 0:
-                    # left-side right-side heavy
-                    self.left_child.rotate_right()
-                # left-side left-side heavy
-                new_top = self.rotate_left()
-
-            if new_top.parent is None:
-                tree.root = new_top
+        weight = self.weigh()
+        if weight < -1:
+            # right side heavy
+            if self.right_child.weigh() > 0:
+                # right-side left-side heavy
+                self.right_child.rotate_left()
+            # right-side right-side heavy
+            new_top = self.rotate_right()
+        elif weight > 1:
+            # left side heavy
+            if self.left_child.weigh() < 0:
+                # left-side right-side heavy
+                self.left_child.rotate_right()
+            # left-side left-side heavy
+            new_top = self.rotate_left()
+        else:
+            return self
+
+        if new_top.parent is None:
+            tree.root = new_top
+        return new_top
 
     def out(self):
         """ Return String Representing Tree From Current Node Down
@@ -195,9 +285,9 @@ class Node():
         self.right_child = swapper
         to_promote.left_child = self
         new_top = self._swap_parents(to_promote, swapper)
-        if swapper is not None:
-            swapper.update_height()
-        self.update_height()
+        # only the two rotated nodes change height, ancestors are left to the caller's retrace
+        self.refresh()
+        to_promote.refresh()
         return new_top
 
     def rotate_left(self):
@@ -209,9 +299,9 @@ class Node():
         self.left_child = swapper
         to_promote.right_child = self
         new_top = self._swap_parents(to_promote, swapper)
-        if swapper is not None:
-            swapper.update_height()
-        self.update_height()
+        # only the two rotated nodes change height, ancestors are left to the caller's retrace
+        self.refresh()
+        to_promote.refresh()
         return new_top
 
     def _swap_parents(self, promote, swapper):
@@ -233,17 +323,119 @@ class Node():
 class BinaryTree():
     """ Binary Search Tree
     Uses AVL Tree
+    key, like the key argument of sorted(), maps a value to the key it is ordered by
     """
-    def __init__(self, *args):
+    REBUILD_FACTOR = 4  # batch operations rebuild once m*log2(n) exceeds this many times n+m
+    node_class = Node  # class of the nodes the tree creates
+    stats_enabled = False
+
+    def __init__(self, iterable=None, key=None, engine="avl", aggregate=None, capacity=None, keep="largest"):
+        if capacity is not None:
+            if engine != "avl" or aggregate is not None:
+                raise ValueError("capacity needs the avl engine and no aggregate")
+            self.__class__ = TopKTree
+            TopKTree.__init__(self, iterable, key, capacity, keep)
+            return
+        if aggregate is not None:
+            if engine != "avl":
+                raise ValueError("aggregates need the avl engine")
+            self.__class__ = AggregateTree
+            AggregateTree.__init__(self, iterable, key, aggregate)
+            return
+        if engine == "btree":
+            self.__class__ = BTree
+            BTree.__init__(self, iterable, key)
+            return
+        elif engine != "avl":
+            raise ValueError("engine must be 'avl' or 'btree'")
         self.root = None  # root Node
         self.element_count = 0
-        if len(args) == 1:
-            for i in args[0]:
-                self.insert(i)
+        self.key = key
+        self.leftmost = None  # cached min Node
+        self.rightmost = None  # cached max Node
+        self.finger = None  # Node most recently inserted, where finger_insert starts searching
+        if iterable is not None:
+            values = list(iterable)
+            sort_keys = values if key is None else [key(v) for v in values]
+            for i in range(1, len(values)):
+                if sort_keys[i] < sort_keys[i - 1]:
+                    values.sort(key=key)
+                    break
+            self.build_from_sorted(values)
+
+    @classmethod
+    def from_sorted(cls, values, names=None, key=None):
+        """ Return A New Tree Built In O(n) From Values Already In Ascending Order
+        names, if given, is a parallel iterable and (value, name) pairs must be in ascending order
+        Duplicate (value, name) pairs are dropped
+        """
+        values = list(values)
+        if names is not None:
+            names = list(names)
+            if len(names) != len(values):
+                raise ValueError("values and names must have the same length")
+        sort_keys = values if key is None else [key(v) for v in values]
+        for i in range(1, len(values)):
+            if sort_keys[i] < sort_keys[i - 1] or (names is not None and sort_keys[i] == sort_keys[i - 1] and
+                                                   names[i] != names[i - 1] and names[i] < names[i - 1]):
+                raise ValueError("values are not sorted at position " + str(i))
+        tree = cls(key=key)
+        tree.build_from_sorted(values, names)
+        return tree
+
+    def build_from_sorted(self, values, names=None):
+        """ Replace Contents With A Perfectly Balanced Tree Of The Sorted values (and names)
+        """
+        # nothing built here can be garbage yet, so spare the cyclic collector from scanning it repeatedly
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            nodes = self.make_nodes(values, names)
+            self.adopt(self.link_balanced(nodes, 0, len(nodes), None))
+        finally:
+            if collecting:
+                gc.enable()
+
+    def make_nodes(self, values, names=None):
+        """ Return Unlinked Nodes For The Sorted values (and names), Dropping Duplicates
+        """
+        nodes = []
+        previous = None
+        for i in range(len(values)):
+            name = None if names is None else names[i]
+            sort_key = values[i] if self.key is None else self.key(values[i])
+            if previous is not None and previous.sort_key == sort_key and previous.name == name:
+                continue
+            previous = self.node_class(values[i], name)
+            previous.sort_key = sort_key
+            nodes.append(previous)
+        return nodes
+
+    def link_balanced(self, nodes, low, high, parent):
+        """ Link nodes[low:high] Into A Balanced Subtree Under parent, Return Its Root
+        """
+        if low >= high:
+            return None
+        middle = (low + high) // 2
+        node = nodes[middle]
+        node.parent = parent
+        node.left_child = self.link_balanced(nodes, low, middle, node)
+        node.right_child = self.link_balanced(nodes, middle + 1, high, node)
+        node.refresh()
+        return node
 
     def __len__(self):
         return self.element_count
 
+    def __contains__(self, value):
+        return self.find(value) is not None
+
+    def __iter__(self):
+        return self.irange()
+
+    def __reversed__(self):
+        return self.irange(reverse=True)
+
     def __str__(self):
         return self.out()
 
@@ -262,37 +454,301 @@ class BinaryTree():
             self.root.balance(self)
 
     def insert(self, value, name=None):
-        if self.root is None:
+        sort_key = value if self.key is None else self.key(value)
+        self.insert_in_subtree(self.root, value, name, sort_key)
+
+    def insert_near(self, finger, value, name=None):
+        """ Insert (value, name), Starting The Search From The Node finger Instead Of The Root
+        Only climbs as high as needed to enclose the new key, but without level links that can be the root
+        even for a neighbouring key, so the search is O(log n) in the worst case
+        Returns the node holding (value, name)
+        """
+        sort_key = value if self.key is None else self.key(value)
+        node = self.root if finger is None else self.climb(finger, sort_key, name)
+        return self.insert_in_subtree(node, value, name, sort_key)
+
+    def climb(self, node, sort_key, name):
+        """ Return The Lowest Ancestor Of node (Or node Itself) Whose Subtree Encloses (sort_key, name)
+        Ancestors reached from the side away from the key are passed without comparing
+        """
+        if self.rightmost.sort_key < sort_key:
+            return self.rightmost
+        if sort_key < self.leftmost.sort_key:
+            return self.leftmost
+        order = node.compare(sort_key, name)
+        if order < 0:
+            parent = node.parent
+            while parent is not None:
+                if node is parent.right_child:
+                    key = parent.sort_key
+                    if key < sort_key or (key == sort_key and name != parent.name and parent.name < name):
+                        break
+                node = parent
+                parent = node.parent
+        elif order > 0:
+            parent = node.parent
+            while parent is not None:
+                if node is parent.left_child:
+                    key = parent.sort_key
+                    if sort_key < key or (key == sort_key and name != parent.name and name < parent.name):
+                        break
+                node = parent
+                parent = node.parent
+        return node
+
+    def insert_in_subtree(self, node, value, name, sort_key):
+        """ Insert Below node (Which Must Enclose sort_key), Returns The Node Holding (value, name)
+        """
+        # single descent: either find the key/name pair or the parent to attach to
+        start = node
+        parent = None
+        is_left = False
+        while node is not None:
+            node_key = node.sort_key
+            if sort_key < node_key:
+                is_left = True
+            elif node_key < sort_key:
+                is_left = False
+            elif name == node.name:
+                # key/name pair already exists in tree
+                if self.stats_enabled:
+                    self.count_descent(node, start)
+                return node
+            else:
+                is_left = name < node.name
+            parent = node
+            node = node.left_child if is_left else node.right_child
+        if self.stats_enabled:
+            self.count_descent(parent, start)
+
+        child_node = self.node_class(value, name)
+        child_node.sort_key = sort_key
+        self.element_count += 1
+        self.finger = child_node
+        if parent is None:
             # If nothing in tree
-            self.root = Node(value, name)
+            self.root = self.leftmost = self.rightmost = child_node
         else:
-            if self.find(value, name) is None:
-                # If key/name pair doesn't exist in tree
-                self.element_count += 1
-                self.add_as_child(self.root, Node(value, name))
+            self.attach(parent, child_node, is_left)
+        return child_node
 
-    def add_as_child(self, parent_node, child_node):
-        if child_node.key < parent_node.key:
-            # should go on left
-            if parent_node.left_child is None:
-                # can add to this node
-                parent_node.left_child = child_node
-                child_node.parent = parent_node
-                child_node.update_height()
+    def finger_insert(self, value, name=None):
+        """ Insert (value, name), Searching From The Most Recently Inserted Node Instead Of The Root
+        O(1) for a key beyond either end of the tree, otherwise O(log n) like insert()
+        Returns the node holding (value, name)
+        """
+        return self.insert_near(self.finger, value, name)
+
+    def insert_beside(self, node, value, name=None, after=True):
+        """ Insert (value, name) Directly After (Or Before) node, Without Searching
+        Raises ValueError if it does not order between node and its neighbour
+        Returns the node holding (value, name)
+        """
+        sort_key = value if self.key is None else self.key(value)
+        neighbour = node.next() if after else node.previous()
+        for adjacent in (node, neighbour):
+            if adjacent is not None and adjacent.compare(sort_key, name) == 0:
+                return adjacent
+        if (node.compare(sort_key, name) < 0) == after or (neighbour is not None and (neighbour.compare(sort_key, name) < 0) != after):
+            raise ValueError(str(value) + " does not belong " + ("after " if after else "before ") + str(node))
+        child_node = self.node_class(value, name)
+        child_node.sort_key = sort_key
+        self.element_count += 1
+        self.finger = child_node
+        if after:
+            if node.right_child is None:
+                self.attach(node, child_node, False)
             else:
-                self.add_as_child(parent_node.left_child, child_node)
+                # the neighbour is the leftmost node of node's right subtree
+                self.attach(neighbour, child_node, True)
         else:
-            # should go on right
-            if parent_node.right_child is None:
-                # can add to this node
-                parent_node.right_child = child_node
-                child_node.parent = parent_node
-                child_node.update_height()
+            if node.left_child is None:
+                self.attach(node, child_node, True)
+            else:
+                self.attach(neighbour, child_node, False)
+        return child_node
+
+    def sorted_batch(self, values, names=None):
+        """ Return values And names As Lists Sorted By (key, name)
+        Arrays with a tolist() method (such as NumPy arrays) are sorted natively before conversion
+        """
+        if hasattr(values, "tolist"):
+            if names is None and self.key is None and hasattr(values, "sort"):
+                values = values.copy()
+                values.sort()
+                return values.tolist(), None
+            values = values.tolist()
+        else:
+            values = list(values)
+        if names is None:
+            values.sort(key=self.key)
+            return values, None
+        names = names.tolist() if hasattr(names, "tolist") else list(names)
+        if len(names) != len(values):
+            raise ValueError("values and names must have the same length")
+        key = self.key
+        pairs = sorted(zip(values, names), key=lambda pair: (pair[0] if key is None else key(pair[0]), pair[1]))
+        return [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+
+    def is_large_batch(self, batch_count):
+        """ True When Rebuilding From A Merge, O(n + m), Beats m Inserts Of O(log n) Each
+        """
+        return batch_count * math.log(self.element_count + 2, 2) > self.REBUILD_FACTOR * (self.element_count + batch_count)
+
+    def in_order_nodes(self):
+        nodes = []
+        node = self.min_node()
+        while node is not None:
+            nodes.append(node)
+            node = node.next()
+        return nodes
+
+    def insert_many(self, values, names=None):
+        """ Insert Every Value (With The Parallel names, If Given) As A Batch
+        Small batches are sorted then inserted, each search starting from the previous insert
+        Large batches are merged with the existing in-order nodes and the tree is relinked balanced
+        """
+        values, names = self.sorted_batch(values, names)
+        if not self.is_large_batch(len(values)):
+            finger = None
+            for i in range(len(values)):
+                finger = self.insert_near(finger, values[i], None if names is None else names[i])
+            return
+
+        existing = self.in_order_nodes()
+        batch = self.make_nodes(values, names)
+        merged = []
+        i = j = 0
+        while i < len(existing) and j < len(batch):
+            if batch[j] < existing[i]:
+                merged.append(batch[j])
+                j += 1
+            else:
+                if not existing[i] < batch[j]:
+                    # already in the tree, keep the existing node
+                    self.absorb(existing[i], batch[j])
+                    j += 1
+                merged.append(existing[i])
+                i += 1
+        merged.extend(existing[i:])
+        merged.extend(batch[j:])
+        self.adopt(self.link_balanced(merged, 0, len(merged), None))
+
+    def absorb(self, node, duplicate):
+        """ Called When A Batch Or union() Brings duplicate, Equal To node Already In The Tree; Only node Is Kept
+        """
+        pass
+
+    def intersect(self, node, duplicate):
+        """ Called When intersection() Keeps node Because other Holds duplicate, Equal To It
+        """
+        pass
+
+    def subtract(self, node, duplicate):
+        """ Called When difference() Meets node And other's Equal duplicate, Returns Whether node Stays
+        """
+        return False
+
+    def remove_many(self, values):
+        """ Remove Every Value As A Batch, Like Calling remove() On Each
+        Large batches filter the in-order nodes in one merge pass and relink the survivors balanced
+        """
+        values, _ = self.sorted_batch(values)
+        if not self.is_large_batch(len(values)):
+            for value in values:
+                self.remove(value)
+            return
+
+        sort_keys = values if self.key is None else [self.key(v) for v in values]
+        kept = []
+        j = 0
+        for node in self.in_order_nodes():
+            while j < len(sort_keys) and sort_keys[j] < node.sort_key:
+                j += 1
+            if j < len(sort_keys) and sort_keys[j] == node.sort_key and node.name is None:
+                node.parent = node.left_child = node.right_child = None
             else:
-                self.add_as_child(parent_node.right_child, child_node)
+                kept.append(node)
+        self.finger = None
+        self.adopt(self.link_balanced(kept, 0, len(kept), None))
+
+    def add_as_child(self, parent_node, child_node):
+        """ Add child_node Somewhere In The Subtree Under parent_node
+        """
+        node = parent_node
+        while True:
+            is_left = child_node < node
+            next_node = node.left_child if is_left else node.right_child
+            if next_node is None:
+                break
+            node = next_node
+        self.attach(node, child_node, is_left)
 
-        if parent_node.weigh() not in [-1, 0, 1]:
-            parent_node.balance(self)
+    def attach(self, parent_node, child_node, is_left):
+        """ Link child_node Into An Empty Child Slot Of parent_node, Then Rebalance Upwards
+        """
+        if is_left:
+            parent_node.left_child = child_node
+            if parent_node is self.leftmost:
+                self.leftmost = child_node
+        else:
+            parent_node.right_child = child_node
+            if parent_node is self.rightmost:
+                self.rightmost = child_node
+        child_node.parent = parent_node
+        self.adjust_sizes(parent_node, 1)
+        self.retrace_insert(parent_node)
+
+    def adjust_sizes(self, node, delta):
+        """ Add delta To The Subtree Size Of node And All Its Ancestors
+        """
+        while node is not None:
+            node.size += delta
+            node = node.parent
+
+    def retrace_insert(self, node):
+        """ Fix Heights From node Upwards After One Of Its Subtrees Grew
+        Stops at the first unchanged height, or after the single (double) rotation an insert can need
+        """
+        steps = 0
+        while node is not None:
+            steps += 1
+            left_height = node.left_child.height if node.left_child is not None else -1
+            right_height = node.right_child.height if node.right_child is not None else -1
+            if left_height - right_height > 1 or right_height - left_height > 1:
+                # rotating restores the subtree's height from before the insert
+                if self.stats_enabled:
+                    self.count_rebalance(node)
+                node.balance(self)
+                break
+            height = (left_height if left_height > right_height else right_height) + 1
+            if node.height == height:
+                break
+            node.height = height
+            node = node.parent
+        if self.stats_enabled:
+            self.retrace_steps += steps
+
+    def retrace(self, node):
+        """ Fix Heights And Balance From node Upwards After One Of Its Subtrees Changed Height
+        Stops at the first subtree whose height is unchanged
+        """
+        steps = 0
+        while node is not None:
+            steps += 1
+            old_height = node.height
+            weight = node.weigh()
+            if weight > 1 or weight < -1:
+                if self.stats_enabled:
+                    self.count_rebalance(node)
+                node = node.balance(self)
+            else:
+                node.height = node.max_child_height() + 1
+            if node.height == old_height:
+                break
+            node = node.parent
+        if self.stats_enabled:
+            self.retrace_steps += steps
 
     def inorder_non_recursive(self):
         node = self.root
@@ -300,10 +756,10 @@ class BinaryTree():
         while node.left_child:
             node = node.left_child
         while node:
-            if node.key.name is not None:
-                retlst.append([node.key.value, node.key.name])
+            if node.name is not None:
+                retlst.append([node.value, node.name])
             else:
-                retlst.append(node.key.value)
+                retlst.append(node.value)
             if node.right_child:
                 node = node.right_child
                 while node.left_child:
@@ -315,54 +771,218 @@ class BinaryTree():
         return retlst
 
     def get_min(self):
+        """ Return The Smallest Element, Or None, In O(1) From The Cached Leftmost Node
+        """
+        return self.element(self.leftmost)
+
+    def get_max(self):
+        return self.element(self.rightmost)
+
+    def peek_min(self):
+        """ Return The Smallest Element In O(1), Raising IndexError If The Tree Is Empty
+        """
+        if len(self) == 0:
+            raise IndexError("peek from an empty tree")
+        return self.get_min()
+
+    def peek_max(self):
+        if len(self) == 0:
+            raise IndexError("peek from an empty tree")
+        return self.get_max()
+
+    def pop_min(self):
+        """ Remove And Return The Smallest Element, Unlinking The Cached Node Without A Search
+        """
+        if self.leftmost is None:
+            raise IndexError("pop from an empty tree")
+        return self.pop_node(self.leftmost)
+
+    def pop_max(self):
+        if self.rightmost is None:
+            raise IndexError("pop from an empty tree")
+        return self.pop_node(self.rightmost)
+
+    def pop_node(self, node):
+        self.remove_node(node)
+        return self.element(node)
+
+    def pushpop(self, value, name=None):
+        """ Insert (value, name) Then Pop The Smallest Element, Like heapq.heappushpop
+        If (value, name) would be the smallest, it is returned without touching the tree
+        """
+        sort_key = value if self.key is None else self.key(value)
+        if self.leftmost is None or self.leftmost.compare(sort_key, name) <= 0:
+            return value if name is None else [value, name]
+        popped = self.pop_min()
+        self.insert(value, name)
+        return popped
+
+    def replace(self, value, name=None):
+        """ Pop The Smallest Element Then Insert (value, name), Like heapq.heapreplace
+        """
+        popped = self.pop_min()
+        self.insert(value, name)
+        return popped
+
+    def min_node(self):
+        return self.leftmost
+
+    def max_node(self):
+        return self.rightmost
+
+    def first_node_from(self, value, inclusive=True):
+        """ Return The First Node Whose Key Is >= value (> value If Not inclusive), Or None
+        """
+        sort_key = value if self.key is None else self.key(value)
+        found = None
         node = self.root
-        if not node:
-            return None
-        while node.left_child:
-            node = node.left_child
-        while node:
-            if node.key.name is not None:
-                return ([node.key.value, node.key.name])
+        while node is not None:
+            if sort_key < node.sort_key or (inclusive and sort_key == node.sort_key):
+                found = node
+                node = node.left_child
             else:
-                return node.key.value
-            if node.right_child:
                 node = node.right_child
-                while node.left_child:
-                    node = node.left_child
+        return found
+
+    def last_node_to(self, value, inclusive=True):
+        """ Return The Last Node Whose Key Is <= value (< value If Not inclusive), Or None
+        """
+        sort_key = value if self.key is None else self.key(value)
+        found = None
+        node = self.root
+        while node is not None:
+            if node.sort_key < sort_key or (inclusive and sort_key == node.sort_key):
+                found = node
+                node = node.right_child
             else:
-                while node.parent and (node == node.parent.right_child):
-                    node = node.parent
-                node = node.parent
-        return None
+                node = node.left_child
+        return found
 
-    def get_max(self):
+    def floor(self, value):
+        """ Return The Last Element Whose Key Is <= value's, Or None; Names Are Ignored
+        """
+        return self.element(self.last_node_to(value, True))
+
+    def ceiling(self, value):
+        """ Return The First Element Whose Key Is >= value's, Or None
+        """
+        return self.element(self.first_node_from(value, True))
+
+    def lower(self, value):
+        """ Return The Last Element Whose Key Is < value's, Or None
+        """
+        return self.element(self.last_node_to(value, False))
+
+    def higher(self, value):
+        """ Return The First Element Whose Key Is > value's, Or None
+        """
+        return self.element(self.first_node_from(value, False))
+
+    def nearest(self, value):
+        """ Return The Element Whose Key Is Closest To value's, The Lower One On A Tie, Or None
+        Keys must support subtraction. Takes one descent, tracking the closest key on either side
+        """
+        sort_key = value if self.key is None else self.key(value)
+        below = above = None
         node = self.root
-        if not node:
-            return None
-        while node.right_child:
-            node = node.right_child
-        while node:
-            if node.key.name is not None:
-                return ([node.key.value, node.key.name])
+        while node is not None:
+            if node.sort_key < sort_key:
+                below = node
+                node = node.right_child
+            elif sort_key < node.sort_key:
+                above = node
+                node = node.left_child
             else:
-                return node.key.value
-            if node.left_child:
+                return self.element(node)
+        if below is None or (above is not None and above.sort_key - sort_key < sort_key - below.sort_key):
+            return self.element(above)
+        return self.element(below)
+
+    def k_nearest(self, value, k):
+        """ Return Up To k Elements Whose Keys Are Closest To value's, Closest First, Lower First On A Tie
+        Keys must support subtraction. Lands with one descent, then steps outward node by node, O(log n + k)
+        """
+        sort_key = value if self.key is None else self.key(value)
+        below = self.last_node_to(value, True)
+        above = below.next() if below is not None else self.min_node()
+        nearest = []
+        while len(nearest) < k and (below is not None or above is not None):
+            if below is None or (above is not None and above.sort_key - sort_key < sort_key - below.sort_key):
+                nearest.append(self.element(above))
+                above = above.next()
+            else:
+                nearest.append(self.element(below))
+                below = below.previous()
+        return nearest
+
+    def seek_node(self, value, name=None):
+        """ Return The First Node At Or After (value, name), Or None
+        With name None, names are ignored and the first node whose key is >= value's is returned
+        """
+        if name is None:
+            return self.first_node_from(value, True)
+        sort_key = value if self.key is None else self.key(value)
+        found = None
+        node = self.root
+        while node is not None:
+            if node.compare(sort_key, name) <= 0:
+                found = node
                 node = node.left_child
-                while node.right_child:
-                    node = node.right_child
             else:
-                while node.parent and (node == node.parent.left_child):
-                    node = node.parent
-                node = node.parent
-        return None
+                node = node.right_child
+        return found
+
+    def cursor(self, value=None, name=None):
+        """ Return A Cursor On The First Element, Or On The First At Or After (value, name)
+        """
+        cursor = Cursor(self)
+        if value is None:
+            cursor.seek_first()
+        else:
+            cursor.seek(value, name)
+        return cursor
+
+    def irange(self, low=None, high=None, inclusive=(True, True), reverse=False, with_names=False):
+        """ Lazily Yield Elements Whose Keys Lie Between low And high, In Order Or In reverse
+        A bound of None leaves that end open. Yields bare values, or (value, name) tuples with with_names
+        Seeks in O(log n), then follows parent pointers, so no list of the range is ever built
+        """
+        for node in self.irange_nodes(low, high, inclusive, reverse):
+            yield (node.value, node.name) if with_names else node.value
+
+    def irange_nodes(self, low=None, high=None, inclusive=(True, True), reverse=False):
+        """ Lazily Yield The Nodes Whose Keys Lie Between low And high, As irange() Does Their Values
+        """
+        first = self.min_node() if low is None else self.first_node_from(low, inclusive[0])
+        last = self.max_node() if high is None else self.last_node_to(high, inclusive[1])
+        if first is None or last is None or last < first:
+            return
+        node, end = (last, first) if reverse else (first, last)
+        while True:
+            yield node
+            if node is end:
+                return
+            node = node.previous() if reverse else node.next()
+
+    def islice(self, start=None, stop=None, reverse=False, with_names=False):
+        """ Lazily Yield The Elements At Sorted Positions start To stop, Like Slicing as_list(1)
+        Seeks in O(log n), then steps one node at a time
+        """
+        start, stop, _ = slice(start, stop).indices(self.element_count)
+        if start >= stop:
+            return
+        node = self.select_node(stop - 1 if reverse else start)
+        for _ in range(stop - start):
+            yield (node.value, node.name) if with_names else node.value
+            node = node.previous() if reverse else node.next()
 
     def preorder(self, node, retlst=None):
         if retlst is None:
             retlst = []
-        if node.key.name is not None:
-            retlst.append([node.key.value, node.key.name])
+        if node.name is not None:
+            retlst.append([node.value, node.name])
         else:
-            retlst.append(node.key.value)
+            retlst.append(node.value)
         if node.left_child:
             retlst = self.preorder(node.left_child, retlst)
         if node.right_child:
@@ -374,10 +994,10 @@ class BinaryTree():
             retlst = []
         if node.left_child:
             retlst = self.inorder(node.left_child, retlst)
-        if node.key.name is not None:
-            retlst.append([node.key.value, node.key.name])
+        if node.name is not None:
+            retlst.append([node.value, node.name])
         else:
-            retlst.append(node.key.value)
+            retlst.append(node.value)
         if node.right_child:
             retlst = self.inorder(node.right_child, retlst)
         return retlst
@@ -389,10 +1009,10 @@ class BinaryTree():
             retlst = self.postorder(node.left_child, retlst)
         if node.right_child:
             retlst = self.postorder(node.right_child, retlst)
-        if node.key.name is not None:
-            retlst.append([node.key.value, node.key.name])
+        if node.name is not None:
+            retlst.append([node.value, node.name])
         else:
-            retlst.append(node.key.value)
+            retlst.append(node.value)
         return retlst
 
     def as_list(self, pre_in_post):
@@ -411,33 +1031,185 @@ class BinaryTree():
         return self.find_in_subtree(self.root, NodeKey(value, name))
 
     def find_in_subtree(self, node, node_key):
+        sort_key = node_key.value if self.key is None else self.key(node_key.value)
+        name = node_key.name
+        start = node
+        while node is not None:
+            key = node.sort_key
+            if sort_key < key:
+                node = node.left_child
+            elif key < sort_key:
+                node = node.right_child
+            elif name == node.name:
+                if self.stats_enabled:
+                    self.count_descent(node, start)
+                return node
+            elif name < node.name:
+                node = node.left_child
+            else:
+                node = node.right_child
+        if self.stats_enabled:
+            self.count_miss(node_key, start)
+        return None  # key not found
+
+    def rank(self, value, name=None):
+        """ Return Number Of Elements Ordered Before (value, name)
+        With name None, counts the elements whose key is less than value's, whatever their names
+        """
+        sort_key = value if self.key is None else self.key(value)
+        rank = 0
+        node = self.root
+        while node is not None:
+            key = node.sort_key
+            if sort_key < key or (sort_key == key and (name is None or (name != node.name and name < node.name))):
+                node = node.left_child
+            else:
+                left_size = node.left_child.size if node.left_child else 0
+                if sort_key == key and name == node.name:
+                    return rank + left_size
+                rank += left_size + 1
+                node = node.right_child
+        return rank
+
+    def count_below(self, value, inclusive):
+        """ Return Number Of Elements Whose Key Is Less Than (Or With inclusive, Equal To) value's
+        """
+        sort_key = value if self.key is None else self.key(value)
+        count = 0
+        node = self.root
+        while node is not None:
+            if sort_key < node.sort_key or (not inclusive and sort_key == node.sort_key):
+                node = node.left_child
+            else:
+                count += (node.left_child.size if node.left_child else 0) + 1
+                node = node.right_child
+        return count
+
+    def count_range(self, low, high):
+        """ Return Number Of Elements With low <= Key <= high
+        """
+        return max(0, self.count_below(high, True) - self.count_below(low, False))
+
+    def select_node(self, index):
+        """ Return The Node At Position index In Sorted Order, Negative Indexes Count From The End
+        """
+        if index < 0:
+            index += self.element_count
+        if not 0 <= index < self.element_count:
+            raise IndexError("tree index out of range")
+        node = self.root
+        while True:
+            left_size = node.left_child.size if node.left_child else 0
+            if index < left_size:
+                node = node.left_child
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right_child
+
+    def select(self, index):
+        return self.element(self.select_node(index))
+
+    def element(self, node):
+        """ Return What Lookups Return For node: The Value, [value, name] For A Named Node, Or None
+        """
         if node is None:
-            return None  # key not found
-        if node_key < node.key:
-            return self.find_in_subtree(node.left_child, node_key)
-        elif node_key > node.key:
-            return self.find_in_subtree(node.right_child, node_key)
-        else:  # key is equal to node key
-            return node
+            return None
+        if node.name is not None:
+            return [node.value, node.name]
+        else:
+            return node.value
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.select(index)
+        start, stop, step = index.indices(self.element_count)
+        positions = range(start, stop, step)
+        retlst = []
+        if len(positions) == 0:
+            return retlst
+        node = self.select_node(start)
+        while True:
+            if node.name is not None:
+                retlst.append([node.value, node.name])
+            else:
+                retlst.append(node.value)
+            if len(retlst) == len(positions):
+                return retlst
+            for _ in range(abs(step)):
+                node = node.next() if step > 0 else node.previous()
+
+    def percentile(self, percent):
+        """ Return The Value At The Given Percentile (0 To 100) By The Nearest-Rank Method
+        """
+        self.check_percent(percent)
+        if len(self) == 0:
+            return None
+        return self.select_node(self.percentile_index(percent)).value
+
+    def check_percent(self, percent):
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100")
+
+    def percentile_index(self, percent):
+        return max(0, int(math.ceil(percent / 100.0 * len(self))) - 1)
+
+    def enable_stats(self, hook=None):
+        """ Start Counting Comparisons, Retracing And Rotations And Timing insert/find/remove, See stats()
+        Swaps this tree into an instrumented subclass; trees without stats only test stats_enabled once per
+        search and retrace
+        hook, if given, is called as hook(operation, seconds, comparisons) after each insert/find/remove
+        """
+        if not self.stats_enabled:
+            self.__class__ = instrumented_class(self.__class__)
+            self.stats_hooks = []
+            self.stats_operation = None
+            self.reset_stats()
+        if hook is not None:
+            self.stats_hooks.append(hook)
+
+    def disable_stats(self):
+        if self.stats_enabled:
+            self.__class__ = self.uninstrumented
+            del self.stats_hooks, self.stats_operation, self.operation_stats
+            del self.comparisons, self.retrace_steps, self.rebalances, self.rotations, self.stats_overhead
+
+    def reset_stats(self):
+        raise ValueError("stats are not enabled, call enable_stats() first")
 
-    def remove(self, key):
+    def stats(self):
+        raise ValueError("stats are not enabled, call enable_stats() first")
+
+    def remove(self, key, name=None):
         # first find
-        node = self.find(key)
+        node = self.find(key, name)
 
         if not node is None:
-            self.element_count -= 1
+            self.remove_node(node)
 
-            if node.is_leaf():
-                # The node is a leaf.  Remove it and return.
-                self.remove_leaf(node)
-            elif (node.left_child is not None and node.right_child is None) or (node.left_child is None and node.right_child is not None):
-                # The node has only 1 child. Make the pointer to this node point to the child of this node.
-                self.remove_branch(node)
-            else:
-                # The node has 2 children. Swap items with the successor (the smallest item in its right subtree) and
-                # delete the successor from the right subtree of the node.
-                assert node.left_child and node.right_child
-                self.swap_with_successor_and_remove(node)
+    def remove_node(self, node):
+        """ Remove A Node Known To Be In This Tree, Without Searching For It
+        """
+        self.element_count -= 1
+        if node is self.finger:
+            self.finger = None
+        if node is self.leftmost:
+            self.leftmost = node.next()
+        if node is self.rightmost:
+            self.rightmost = node.previous()
+
+        if node.is_leaf():
+            # The node is a leaf.  Remove it and return.
+            self.remove_leaf(node)
+        elif (node.left_child is not None and node.right_child is None) or (node.left_child is None and node.right_child is not None):
+            # The node has only 1 child. Make the pointer to this node point to the child of this node.
+            self.remove_branch(node)
+        else:
+            # The node has 2 children. Swap items with the successor (the smallest item in its right subtree) and
+            # delete the successor from the right subtree of the node.
+            assert node.left_child and node.right_child
+            self.swap_with_successor_and_remove(node)
 
     def remove_leaf(self, node):
         parent = node.parent
@@ -447,39 +1219,25 @@ class BinaryTree():
             else:
                 assert (parent.right_child == node)
                 parent.right_child = None
-            parent.update_height()
+            self.adjust_sizes(parent, -1)
+            self.retrace(parent)
         else:
             self.root = None
 
-        # rebalance
-        node = parent
-        while node:
-            if not node.weigh() in [-1, 0, 1]:
-                node.balance(self)
-            node = node.parent
-
     def remove_branch(self, node):
         parent = node.parent
+        child = node.right_child or node.left_child
+        child.parent = parent
         if parent:
             if parent.left_child == node:
-                parent.left_child = node.right_child or node.left_child
+                parent.left_child = child
             else:
                 assert (parent.right_child == node)
-                parent.right_child = node.right_child or node.left_child
-
-            if node.left_child:
-                node.left_child.parent = parent
-            else:
-                assert node.right_child
-                node.right_child.parent = parent
-            parent.update_height()
-
-        # rebalance
-        node = parent
-        while node:
-            if not node.weigh() in [-1, 0, 1]:
-                node.balance(self)
-            node = node.parent
+                parent.right_child = child
+            self.adjust_sizes(parent, -1)
+            self.retrace(parent)
+        else:
+            self.root = child
 
     def swap_with_successor_and_remove(self, node):
         successor = node.right_child
@@ -504,10 +1262,13 @@ class BinaryTree():
         assert (left_child_2 is None)
         right_child_2 = node_2.right_child
 
-        # swap heights
+        # swap heights and subtree sizes
         tmp = node_1.height
         node_1.height = node_2.height
         node_2.height = tmp
+        tmp = node_1.size
+        node_1.size = node_2.size
+        node_2.size = tmp
 
         if parent_1:
             if parent_1.left_child == node_1:
@@ -538,30 +1299,2476 @@ class BinaryTree():
 
             # use for debug only and only with small trees
 
-    def out(self, start_node=None):
-        if start_node is None:
-            start_node = self.root
-
-        if start_node is None:
-            return None
+    def save(self, path):
+        """ Write The Elements In Order To A Compact Binary Snapshot, Read Back By BinaryTree.load()
+        Values must be numbers: a column of int64 if all are integers, else of float64. Integers that int64
+        (or, next to floats, float64) cannot hold exactly raise ValueError rather than load back changed
+        Names must be all None, or all strings (stored as UTF-8 behind an int64 offsets column)
+        """
+        items = list(self.irange(with_names=True))
+        values = [item[0] for item in items]
+        names = [item[1] for item in items]
+        del items
+        value_types = set(map(type, values))
+        name_types = set(map(type, names))
+        if not all(issubclass(value_type, numbers.Real) for value_type in value_types):
+            raise TypeError("snapshot values must be numbers")
+        if all(issubclass(value_type, numbers.Integral) for value_type in value_types):
+            value_format = "q"
+            limit = 2 ** 63
         else:
-            return start_node.out()
+            value_format = "d"
+            limit = 2 ** 53
+        integers = [value for value in values if isinstance(value, numbers.Integral)]
+        if integers and not (-limit <= min(integers) and max(integers) < limit):
+            raise ValueError("integer values must lie in [-2**%d, 2**%d) to be saved exactly" %
+                             ((63, 63) if value_format == "q" else (53, 53)))
+        has_names = name_types != set([type(None)]) and len(names) > 0
+        if has_names and not all(issubclass(name_type, (bytes, type(u""))) for name_type in name_types):
+            raise TypeError("snapshot names must be all None or all strings")
 
+        with open(path, "wb") as snapshot:
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(values), value_format.encode("ascii"),
+                                          b"s" if has_names else b"n")
+            snapshot.write(header + b"\0" * (SNAPSHOT_HEADER_SIZE - len(header)))
+            self.write_column(snapshot, value_format, values)
+            if has_names:
+                encoded = [name if isinstance(name, bytes) else name.encode("utf-8") for name in names]
+                offsets = [0] * (len(encoded) + 1)
+                for i in range(len(encoded)):
+                    offsets[i + 1] = offsets[i] + len(encoded[i])
+                self.write_column(snapshot, "q", offsets)
+                snapshot.write(b"".join(encoded))
 
-def test():
-    def random_data_generator(count, max_val):
-        for n in xrange(count):
-            yield random.randint(0, max_val)
+    def write_column(self, snapshot, value_format, values):
+        for start in range(0, len(values), SNAPSHOT_CHUNK):
+            chunk = values[start:start + SNAPSHOT_CHUNK]
+            snapshot.write(struct.pack("<%d%s" % (len(chunk), value_format), *chunk))
 
-    def sanity_check(tree=None, node=None):
-        if node is None and tree is not None:
-            node = tree.root
-        if (node is None) or (node.is_leaf() and node.parent is None):
-            # trivial - no sanity check needed, as either the tree is empty or there is only one node in the tree
-            pass
-        else:
-            if node.height != node.max_child_height() + 1:
-                raise Exception("Invalid height for node " + str(node) + ": " + str(node.height) + " instead of " + str(node.max_child_height() + 1) + "!")
+    @classmethod
+    def load(cls, path, mmap=True, key=None):
+        """ Open A Snapshot Written By save()
+        With mmap, returns a MappedBinaryTree that answers queries from the read-only mapped file and only
+        builds nodes on its first mutation; otherwise builds the balanced tree right away in O(n)
+        """
+        if mmap and cls is not BinaryTree:
+            raise TypeError("only BinaryTree snapshots can be mapped, load %s with mmap=False" % cls.__name__)
+        snapshot = SnapshotFile(path)
+        if mmap:
+            return MappedBinaryTree(key=key, snapshot=snapshot)
+        tree = cls(key=key)
+        tree.build_from_sorted(snapshot.values(0, snapshot.count), snapshot.names(0, snapshot.count))
+        snapshot.close()
+        return tree
+
+    def split(self, value):
+        """ Split Into Two Trees, Keys Less Than value's And Keys Greater Or Equal, In O(log n)
+        The nodes move to the returned trees, leaving this tree empty
+        """
+        sort_key = value if self.key is None else self.key(value)
+        less = self.empty_like()
+        greater = self.empty_like()
+        less_root, _, greater_root = less.split_nodes(self.release_root(), sort_key, None, False)
+        less.adopt(less_root)
+        greater.adopt(greater_root)
+        return less, greater
+
+    @classmethod
+    def join(cls, left, right):
+        """ Return One Tree Of left's Elements Followed By right's, In O(log n)
+        Every key in left must order before every key in right; both trees are left empty
+        """
+        left.check_compatible(right)
+        if len(left) and len(right) and not left.max_node() < right.min_node():
+            raise ValueError("keys of left must all order before keys of right")
+        tree = left.empty_like()
+        tree.adopt(tree.join_two(left.release_root(), right.release_root()))
+        return tree
+
+    def union(self, other):
+        """ Return A Tree Of Elements In Either Tree, In O(m log(n/m + 1)) For Sizes m <= n
+        Consumes both operands: their nodes are moved into the result or dropped, and self and other are left
+        empty. Rebuild copies first (e.g. BinaryTree(tree)) to keep them
+        """
+        self.check_compatible(other)
+        tree = self.empty_like()
+        tree.adopt(tree.union_nodes(self.release_root(), other.release_root()))
+        return tree
+
+    def intersection(self, other):
+        """ Return A Tree Of Elements In Both Trees, In O(m log(n/m + 1)) For Sizes m <= n
+        Consumes both operands: their nodes are moved into the result or dropped, and self and other are left
+        empty. Rebuild copies first (e.g. BinaryTree(tree)) to keep them
+        """
+        self.check_compatible(other)
+        tree = self.empty_like()
+        tree.adopt(tree.intersection_nodes(self.release_root(), other.release_root()))
+        return tree
+
+    def difference(self, other):
+        """ Return A Tree Of Elements In This Tree But Not In other, In O(m log(n/m + 1)) For Sizes m <= n
+        Consumes both operands: their nodes are moved into the result or dropped, and self and other are left
+        empty. Rebuild copies first (e.g. BinaryTree(tree)) to keep them
+        """
+        self.check_compatible(other)
+        tree = self.empty_like()
+        tree.adopt(tree.difference_nodes(self.release_root(), other.release_root()))
+        return tree
+
+    def empty_like(self):
+        """ Return A New Empty Tree Configured Like This One, To Receive Nodes Moved From It
+        """
+        return self.__class__(key=self.key)
+
+    def node_signature(self):
+        """ What Nodes Must Share To Move Between Trees: The Node Class Here, The Aggregate On AggregateTree
+        """
+        return self.node_class
+
+    def check_compatible(self, other):
+        """ Raise ValueError, Before Either Tree Is Touched, Unless other's Nodes Can Join This Tree's
+        """
+        if not isinstance(other, BinaryTree) or other.node_signature() != self.node_signature():
+            raise ValueError("cannot combine a %s with a %s built with a different node class or aggregate" %
+                             (self.__class__.__name__, other.__class__.__name__))
+
+    def release_root(self):
+        """ Empty The Tree And Return Its Former Root
+        """
+        root = self.root
+        self.root = self.leftmost = self.rightmost = self.finger = None
+        self.element_count = 0
+        return root
+
+    def adopt(self, root):
+        """ Make The Detached Subtree root The Whole Tree
+        """
+        self.root = self.leftmost = self.rightmost = root
+        self.element_count = root.size if root is not None else 0
+        if root is not None:
+            while self.leftmost.left_child is not None:
+                self.leftmost = self.leftmost.left_child
+            while self.rightmost.right_child is not None:
+                self.rightmost = self.rightmost.right_child
+
+    def detach_children(self, node):
+        left, right = node.left_child, node.right_child
+        if left is not None:
+            left.parent = None
+        if right is not None:
+            right.parent = None
+        return left, right
+
+    def link_pivot(self, left, pivot, right):
+        pivot.left_child = left
+        pivot.right_child = right
+        if left is not None:
+            left.parent = pivot
+        if right is not None:
+            right.parent = pivot
+        pivot.refresh()
+
+    def join_nodes(self, left, pivot, right):
+        """ Join Subtree left, Node pivot And Subtree right (In Key Order) Into One Subtree, Returns Its Root
+        Costs O(|height(left) - height(right)| + 1); self.root is only used as scratch by the rotations,
+        so call this on the tree that will adopt the result
+        """
+        left_height = left.height if left is not None else -1
+        right_height = right.height if right is not None else -1
+        pivot.parent = None
+        if left_height > right_height + 1:
+            # walk down the right spine of left to the first subtree no more than one taller than right
+            parent = None
+            node = left
+            while node is not None and node.height > right_height + 1:
+                parent, node = node, node.right_child
+            self.root = left
+            self.link_pivot(node, pivot, right)
+            parent.right_child = pivot
+        elif right_height > left_height + 1:
+            parent = None
+            node = right
+            while node is not None and node.height > left_height + 1:
+                parent, node = node, node.left_child
+            self.root = right
+            self.link_pivot(left, pivot, node)
+            parent.left_child = pivot
+        else:
+            self.link_pivot(left, pivot, right)
+            return pivot
+        # pivot took the place of node, one level taller, so retrace like an insert
+        pivot.parent = parent
+        self.adjust_sizes(parent, pivot.size - (node.size if node is not None else 0))
+        self.retrace(parent)
+        return self.root
+
+    def join_two(self, left, right):
+        """ Join Subtrees left And right (In Key Order) Into One Subtree, Returns Its Root
+        """
+        if left is None:
+            return right
+        if right is None:
+            return left
+        left, last = self.split_last(left)
+        return self.join_nodes(left, last, right)
+
+    def split_last(self, node):
+        """ Remove The Last Node Of Subtree node, Returns (Remaining Subtree Root, Last Node)
+        """
+        left, right = self.detach_children(node)
+        if right is None:
+            return left, node
+        rest, last = self.split_last(right)
+        return self.join_nodes(left, node, rest), last
+
+    def split_nodes(self, node, sort_key, name, exact):
+        """ Split Subtree node Around (sort_key, name), Returns (Less, Equal Node Or None, Greater) Subtree Roots
+        Without exact, names are ignored and nodes whose key equals sort_key go to Greater
+        """
+        if node is None:
+            return None, None, None
+        left, right = self.detach_children(node)
+        if exact:
+            order = node.compare(sort_key, name)
+            if order == 0:
+                return left, node, right
+        else:
+            order = 1 if node.sort_key < sort_key else -1
+        if order < 0:
+            less, found, greater = self.split_nodes(left, sort_key, name, exact)
+            return less, found, self.join_nodes(greater, node, right)
+        else:
+            less, found, greater = self.split_nodes(right, sort_key, name, exact)
+            return self.join_nodes(left, node, less), found, greater
+
+    def union_nodes(self, node, other):
+        if node is None:
+            return other
+        if other is None:
+            return node
+        left, right = self.detach_children(node)
+        less, found, greater = self.split_nodes(other, node.sort_key, node.name, True)
+        if found is not None:
+            self.absorb(node, found)
+        return self.join_nodes(self.union_nodes(left, less), node, self.union_nodes(right, greater))
+
+    def intersection_nodes(self, node, other):
+        if node is None or other is None:
+            return None
+        left, right = self.detach_children(node)
+        less, found, greater = self.split_nodes(other, node.sort_key, node.name, True)
+        left = self.intersection_nodes(left, less)
+        right = self.intersection_nodes(right, greater)
+        if found is None:
+            return self.join_two(left, right)
+        self.intersect(node, found)
+        return self.join_nodes(left, node, right)
+
+    def difference_nodes(self, node, other):
+        if node is None or other is None:
+            return node
+        other_left, other_right = self.detach_children(other)
+        less, found, greater = self.split_nodes(node, other.sort_key, other.name, True)
+        less = self.difference_nodes(less, other_left)
+        greater = self.difference_nodes(greater, other_right)
+        if found is not None and self.subtract(found, other):
+            return self.join_nodes(less, found, greater)
+        return self.join_two(less, greater)
+
+    def out(self, start_node=None):
+        if start_node is None:
+            start_node = self.root
+
+        if start_node is None:
+            return None
+        else:
+            return start_node.out()
+
+
+INSTRUMENTED_CLASSES = {}
+
+
+def instrumented_class(cls):
+    """ Return The Subclass Of cls That enable_stats() Swaps A Tree Into, Created Once Per Class
+    It wraps the public operations with timers and supplies the counting hooks the search and retrace loops call
+    """
+    if cls in INSTRUMENTED_CLASSES:
+        return INSTRUMENTED_CLASSES[cls]
+
+    class Instrumented(cls):
+        stats_enabled = True
+        uninstrumented = cls
+
+        def reset_stats(self):
+            self.operation_stats = dict((operation, {"calls": 0, "seconds": 0.0, "comparisons": 0, "histogram": {}})
+                                        for operation in ("insert", "find", "remove"))
+            self.comparisons = 0  # sort key comparisons made while searching
+            self.retrace_steps = 0  # nodes visited while retracing after insert/remove
+            self.rebalances = 0  # calls to Node.balance() that rotated
+            self.rotations = 0  # single rotations, a double rotation counts twice
+            self.stats_overhead = 0.0  # seconds spent counting, kept out of the latencies
+
+        def stats(self):
+            """ Return The Counters, Per-Operation Latency Histograms And Height Against The AVL Bound
+            A histogram maps a bound in microseconds to the number of calls that took less than it
+            """
+            operations = {}
+            for operation, stats in self.operation_stats.items():
+                operations[operation] = dict(stats, histogram=dict(stats["histogram"]))
+            return {"operations": operations, "comparisons": self.comparisons, "retrace_steps": self.retrace_steps,
+                    "rebalances": self.rebalances, "rotations": self.rotations, "count": len(self),
+                    "height": self.height(), "height_bound": 1.44 * math.log(len(self) + 2, 2)}
+
+        def stats_report(self):
+            stats = self.stats()
+            lines = ["height %d, AVL bound 1.44*log2(N+2) = %.1f for N = %d" %
+                     (stats["height"], stats["height_bound"], stats["count"])]
+            for operation in ("insert", "find", "remove"):
+                calls = stats["operations"][operation]["calls"]
+                if calls:
+                    lines.append("%s: %d calls, %.2fus and %.1f comparisons per call" %
+                                 (operation, calls, stats["operations"][operation]["seconds"] * 1e6 / calls,
+                                  float(stats["operations"][operation]["comparisons"]) / calls))
+            lines.append("%d nodes retraced, %d rebalances, %d rotations" %
+                         (stats["retrace_steps"], stats["rebalances"], stats["rotations"]))
+            return "\n".join(lines)
+
+        def timed(self, operation, method, *args):
+            """ Call method, Recording It As operation Unless It Runs Inside Another Recorded Call
+            """
+            if self.stats_operation is not None:
+                return method(self, *args)
+            self.stats_operation = operation
+            comparisons = self.comparisons
+            overhead = self.stats_overhead
+            start = timeit.default_timer()
+            try:
+                result = method(self, *args)
+            finally:
+                self.stats_operation = None
+            seconds = timeit.default_timer() - start - (self.stats_overhead - overhead)
+            comparisons = self.comparisons - comparisons
+            stats = self.operation_stats[operation]
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["comparisons"] += comparisons
+            bucket = 1 << int(seconds * 1e6).bit_length()
+            stats["histogram"][bucket] = stats["histogram"].get(bucket, 0) + 1
+            for hook in self.stats_hooks:
+                hook(operation, seconds, comparisons)
+            return result
+
+        def empty_like(self):
+            tree = cls.empty_like(self)
+            tree.__class__ = cls
+            return tree
+
+        def insert(self, value, name=None):
+            return self.timed("insert", cls.insert, value, name)
+
+        def insert_near(self, finger, value, name=None):
+            return self.timed("insert", cls.insert_near, finger, value, name)
+
+        def find(self, value, name=None):
+            return self.timed("find", cls.find, value, name)
+
+        def remove(self, key, name=None):
+            return self.timed("remove", cls.remove, key, name)
+
+        def insert_in_subtree(self, node, value, name, sort_key):
+            # every insert path ends here, so each one is recorded as an insert
+            return self.timed("insert", cls.insert_in_subtree, node, value, name, sort_key)
+
+        def count_descent(self, last, start):
+            """ Count The Nodes A Search From start Compared Against, Ending At last, By Climbing Back Up
+            """
+            began = timeit.default_timer()
+            node = last
+            while node is not None:
+                self.comparisons += 1
+                if node is start:
+                    break
+                node = node.parent
+            self.stats_overhead += timeit.default_timer() - began
+
+        def count_miss(self, node_key, start):
+            """ Count A Search That Found Nothing: It Ended At The Deeper Of The Neighbours Of node_key
+            """
+            began = timeit.default_timer()
+            after = self.seek_node(node_key.value, node_key.name)
+            before = after.previous() if after is not None else self.max_node()
+            last = after
+            if before is not None and (after is None or self.depth(before) > self.depth(after)):
+                last = before
+            self.stats_overhead += timeit.default_timer() - began
+            self.count_descent(last, start)
+
+        def depth(self, node):
+            depth = 0
+            while node.parent is not None:
+                depth += 1
+                node = node.parent
+            return depth
+
+        def count_rebalance(self, node):
+            weight = node.weigh()
+            child = node.left_child if weight > 1 else node.right_child
+            self.rebalances += 1
+            self.rotations += 2 if (child.weigh() < 0 if weight > 1 else child.weigh() > 0) else 1
+
+    Instrumented.__name__ = "Instrumented" + cls.__name__
+    INSTRUMENTED_CLASSES[cls] = Instrumented
+    return Instrumented
+
+
+class BTree():
+    """ Sorted Container Of Wide Leaves, What BinaryTree(engine="btree") Builds Instead Of AVL Nodes
+    Elements are (sort_key, name, value) tuples kept in sorted Python lists of LOAD to 2 * LOAD entries.
+    A search is two bisects, over the leaves' last entries and then within one leaf, instead of a pointer
+    chase per level, which suits CPython. Only insert/find/remove, min/max, irange and in-order traversal
+    exist; it has no nodes, so it is not a BinaryTree and the node-based methods are simply absent
+    """
+    LOAD = 512  # leaves split above 2 * LOAD entries and merge below LOAD / 2
+
+    def __init__(self, iterable=None, key=None):
+        self.key = key
+        self.leaves = []  # sorted lists of (sort_key, name, value)
+        self.maxes = []  # last entry of each leaf
+        self.element_count = 0
+        if iterable is not None:
+            entries = []
+            for value in sorted(iterable, key=key):
+                sort_key = value if key is None else key(value)
+                if not entries or entries[-1][0] != sort_key:
+                    entries.append((sort_key, None, value))
+            self.leaves = [entries[i:i + self.LOAD] for i in range(0, len(entries), self.LOAD)]
+            self.maxes = [leaf[-1] for leaf in self.leaves]
+            self.element_count = len(entries)
+
+    def __len__(self):
+        return self.element_count
+
+    def __contains__(self, value):
+        return self.find(value) is not None
+
+    def __iter__(self):
+        return self.irange()
+
+    def __reversed__(self):
+        return self.irange(reverse=True)
+
+    def element(self, entry):
+        return entry[2] if entry[1] is None else [entry[2], entry[1]]
+
+    def locate(self, sort_key, name):
+        """ Return (Leaf Index, Position In Leaf) Where (sort_key, name) Is Or Would Be Inserted
+        """
+        # a 2-tuple probe sorts just before the 3-tuple entry with the same key and name, values are never compared
+        probe = (sort_key, name)
+        i = bisect.bisect_left(self.maxes, probe)
+        if i == len(self.maxes):
+            i -= 1
+        return i, bisect.bisect_left(self.leaves[i], probe)
+
+    def insert(self, value, name=None):
+        sort_key = value if self.key is None else self.key(value)
+        entry = (sort_key, name, value)
+        if not self.leaves:
+            self.leaves.append([entry])
+            self.maxes.append(entry)
+            self.element_count = 1
+            return
+        i, j = self.locate(sort_key, name)
+        leaf = self.leaves[i]
+        if j < len(leaf) and leaf[j][0] == sort_key and leaf[j][1] == name:
+            return
+        leaf.insert(j, entry)
+        self.element_count += 1
+        if j == len(leaf) - 1:
+            self.maxes[i] = entry
+        if len(leaf) > 2 * self.LOAD:
+            self.maxes[i] = leaf[self.LOAD - 1]
+            self.leaves.insert(i + 1, leaf[self.LOAD:])
+            self.maxes.insert(i + 1, leaf[-1])
+            del leaf[self.LOAD:]
+
+    def find(self, value, name=None):
+        """ Return A NodeKey Of The Stored (value, name), Or None
+        """
+        if not self.leaves:
+            return None
+        sort_key = value if self.key is None else self.key(value)
+        i, j = self.locate(sort_key, name)
+        leaf = self.leaves[i]
+        if j < len(leaf) and leaf[j][0] == sort_key and leaf[j][1] == name:
+            return NodeKey(leaf[j][2], name)
+        return None
+
+    def remove(self, key, name=None):
+        if not self.leaves:
+            return
+        sort_key = key if self.key is None else self.key(key)
+        i, j = self.locate(sort_key, name)
+        leaf = self.leaves[i]
+        if j == len(leaf) or leaf[j][0] != sort_key or leaf[j][1] != name:
+            return
+        del leaf[j]
+        self.element_count -= 1
+        if not leaf:
+            del self.leaves[i], self.maxes[i]
+            return
+        self.maxes[i] = leaf[-1]
+        if len(leaf) < self.LOAD // 2 and len(self.leaves) > 1:
+            # merge with a neighbour, splitting again if that overfills it
+            k = i if i + 1 < len(self.leaves) else i - 1
+            merged = self.leaves[k] + self.leaves[k + 1]
+            if len(merged) > 2 * self.LOAD:
+                middle = len(merged) // 2
+                self.leaves[k:k + 2] = [merged[:middle], merged[middle:]]
+                self.maxes[k:k + 2] = [merged[middle - 1], merged[-1]]
+            else:
+                self.leaves[k:k + 2] = [merged]
+                self.maxes[k:k + 2] = [merged[-1]]
+
+    def get_min(self):
+        return self.element(self.leaves[0][0]) if self.leaves else None
+
+    def get_max(self):
+        return self.element(self.maxes[-1]) if self.leaves else None
+
+    def peek_min(self):
+        if not self.leaves:
+            raise IndexError("peek from an empty tree")
+        return self.get_min()
+
+    def peek_max(self):
+        if not self.leaves:
+            raise IndexError("peek from an empty tree")
+        return self.get_max()
+
+    def height(self):
+        return 2 if self.leaves else 0
+
+    def irange(self, low=None, high=None, inclusive=(True, True), reverse=False, with_names=False):
+        """ Lazily Yield Elements Whose Keys Lie Between low And high, In Order Or In reverse
+        A bound of None leaves that end open. Yields bare values, or (value, name) tuples with with_names
+        """
+        if not self.leaves:
+            return
+        if low is None:
+            start = (0, 0)
+        else:
+            low_key = low if self.key is None else self.key(low)
+            start = self.bound(low_key, not inclusive[0])
+        if high is None:
+            stop = (len(self.leaves) - 1, len(self.leaves[-1]))
+        else:
+            high_key = high if self.key is None else self.key(high)
+            stop = self.bound(high_key, inclusive[1])
+        leaves = range(start[0], stop[0] + 1)
+        for i in (reversed(leaves) if reverse else leaves):
+            leaf = self.leaves[i]
+            first = start[1] if i == start[0] else 0
+            last = stop[1] if i == stop[0] else len(leaf)
+            positions = range(first, last)
+            for j in (reversed(positions) if reverse else positions):
+                entry = leaf[j]
+                yield (entry[2], entry[1]) if with_names else entry[2]
+
+    def bound(self, sort_key, after):
+        """ Return (Leaf Index, Position) Of The First Entry With Key >= sort_key (> sort_key If after)
+        """
+        maxes = self.maxes
+        low, high = 0, len(maxes)
+        while low < high:
+            middle = (low + high) // 2
+            key = maxes[middle][0]
+            if key < sort_key or (after and key == sort_key):
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(maxes):
+            return len(maxes) - 1, len(self.leaves[-1])
+        leaf = self.leaves[low]
+        first, last = 0, len(leaf)
+        while first < last:
+            middle = (first + last) // 2
+            key = leaf[middle][0]
+            if key < sort_key or (after and key == sort_key):
+                first = middle + 1
+            else:
+                last = middle
+        return low, first
+
+    def as_list(self, pre_in_post=1):
+        """ Return The Elements In Order; Only In-Order Traversal (1 Or 3) Exists Without Binary Nodes
+        """
+        if pre_in_post not in (1, 3):
+            raise ValueError("the btree engine only has in-order traversal")
+        return [self.element(entry) for leaf in self.leaves for entry in leaf]
+
+
+class SnapshotFile(object):
+    """ Read-Only, Memory-Mapped Columns Of A File Written By BinaryTree.save()
+    """
+    def __init__(self, path):
+        with open(path, "rb") as snapshot:
+            self.buffer = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, value_type, name_type = SNAPSHOT_HEADER.unpack_from(self.buffer, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError(path + " is not a binary tree snapshot")
+        self.count = count
+        self.value_format = str(value_type.decode("ascii"))
+        self.value_struct = struct.Struct("<" + self.value_format)
+        self.has_names = name_type == b"s"
+        self.offsets_start = SNAPSHOT_HEADER_SIZE + 8 * count
+        self.names_start = self.offsets_start + 8 * (count + 1)
+
+    def close(self):
+        self.buffer.close()
+
+    def value(self, index):
+        return self.value_struct.unpack_from(self.buffer, SNAPSHOT_HEADER_SIZE + 8 * index)[0]
+
+    def values(self, start, stop):
+        return list(struct.unpack_from("<%d%s" % (stop - start, self.value_format), self.buffer,
+                                       SNAPSHOT_HEADER_SIZE + 8 * start))
+
+    def name(self, index):
+        if not self.has_names:
+            return None
+        start, stop = struct.unpack_from("<2q", self.buffer, self.offsets_start + 8 * index)
+        return self.buffer[self.names_start + start:self.names_start + stop].decode("utf-8")
+
+    def names(self, start, stop):
+        if not self.has_names:
+            return None
+        offsets = struct.unpack_from("<%dq" % (stop - start + 1), self.buffer, self.offsets_start + 8 * start)
+        return [self.buffer[self.names_start + offsets[i]:self.names_start + offsets[i + 1]].decode("utf-8")
+                for i in range(stop - start)]
+
+
+def materializing(method):
+    """ Wrap A BinaryTree Method So A MappedBinaryTree Builds Its Nodes Before Running It
+    """
+    def wrapper(self, *args, **kwargs):
+        self.materialize()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class MappedBinaryTree(BinaryTree):
+    """ BinaryTree Served Straight From A Memory-Mapped Snapshot, See BinaryTree.load()
+    The sorted columns are an implicit balanced tree: bisecting them follows the same path as descending the
+    tree link_balanced() would build, so lookups, ranks and ranges need no Node objects.
+    The first mutation, or a cursor, builds the tree; from then on it is a plain BinaryTree. find() and
+    select_node() read the mapping and return detached Node copies, which the node-taking mutations
+    (remove_node(), insert_beside(), insert_near()) swap for the tree's own node once it is built.
+    """
+    def __init__(self, iterable=None, key=None, snapshot=None):
+        BinaryTree.__init__(self, iterable, key)
+        self.snapshot = snapshot
+        if snapshot is not None:
+            self.element_count = snapshot.count
+
+    def materialize(self):
+        """ Build The Nodes From The Snapshot And Release The Mapping
+        """
+        snapshot = self.snapshot
+        if snapshot is not None:
+            self.snapshot = None
+            self.build_from_sorted(snapshot.values(0, snapshot.count), snapshot.names(0, snapshot.count))
+            snapshot.close()
+
+    # mutations, and anything handing out real nodes
+    insert = materializing(BinaryTree.insert)
+    finger_insert = materializing(BinaryTree.finger_insert)
+    add_as_child = materializing(BinaryTree.add_as_child)
+    insert_many = materializing(BinaryTree.insert_many)
+    remove = materializing(BinaryTree.remove)
+    remove_many = materializing(BinaryTree.remove_many)
+    pop_min = materializing(BinaryTree.pop_min)
+    pop_max = materializing(BinaryTree.pop_max)
+    pushpop = materializing(BinaryTree.pushpop)
+    replace = materializing(BinaryTree.replace)
+    split = materializing(BinaryTree.split)
+    union = materializing(BinaryTree.union)
+    intersection = materializing(BinaryTree.intersection)
+    difference = materializing(BinaryTree.difference)
+    release_root = materializing(BinaryTree.release_root)
+    balance = materializing(BinaryTree.balance)
+    cursor = materializing(BinaryTree.cursor)
+    seek_node = materializing(BinaryTree.seek_node)
+    min_node = materializing(BinaryTree.min_node)
+    max_node = materializing(BinaryTree.max_node)
+    first_node_from = materializing(BinaryTree.first_node_from)
+    last_node_to = materializing(BinaryTree.last_node_to)
+    in_order_nodes = materializing(BinaryTree.in_order_nodes)
+    irange_nodes = materializing(BinaryTree.irange_nodes)
+    inorder_non_recursive = materializing(BinaryTree.inorder_non_recursive)
+    out = materializing(BinaryTree.out)
+
+    def resolve(self, node):
+        """ Return The Tree's Own Node For node, Which May Be A Detached Copy From find() Or select_node()
+        """
+        if node is not None and node.parent is None and node is not self.root:
+            node = BinaryTree.find(self, node.value, node.name)
+            if node is None:
+                raise ValueError("node is not in this tree")
+        return node
+
+    def remove_node(self, node):
+        self.materialize()
+        BinaryTree.remove_node(self, self.resolve(node))
+
+    def insert_beside(self, node, value, name=None, after=True):
+        self.materialize()
+        return BinaryTree.insert_beside(self, self.resolve(node), value, name, after)
+
+    def insert_near(self, finger, value, name=None):
+        self.materialize()
+        return BinaryTree.insert_near(self, self.resolve(finger), value, name)
+
+    def sort_key_at(self, index):
+        value = self.snapshot.value(index)
+        return value if self.key is None else self.key(value)
+
+    def node_at(self, index):
+        node = self.node_class(self.snapshot.value(index), self.snapshot.name(index))
+        node.sort_key = node.value if self.key is None else self.key(node.value)
+        return node
+
+    def item_at(self, index):
+        name = self.snapshot.name(index)
+        if name is not None:
+            return [self.snapshot.value(index), name]
+        else:
+            return self.snapshot.value(index)
+
+    def bisect(self, sort_key, name, after):
+        """ Return The First Position Ordering After (sort_key, name), Or At Or After It Unless after
+        With name None, names are ignored
+        """
+        snapshot = self.snapshot
+        unpack_from = snapshot.value_struct.unpack_from
+        low = 0
+        high = snapshot.count
+        while low < high:
+            middle = (low + high) // 2
+            key = unpack_from(snapshot.buffer, SNAPSHOT_HEADER_SIZE + 8 * middle)[0]
+            if self.key is not None:
+                key = self.key(key)
+            if key < sort_key:
+                before = True
+            elif sort_key < key:
+                before = False
+            elif name is None:
+                before = after
+            else:
+                middle_name = snapshot.name(middle)
+                before = after if middle_name == name else middle_name < name
+            if before:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, value, name=None):
+        if self.snapshot is None:
+            return BinaryTree.find(self, value, name)
+        sort_key = value if self.key is None else self.key(value)
+        index = self.bisect(sort_key, name, False)
+        if index < self.snapshot.count and self.sort_key_at(index) == sort_key and self.snapshot.name(index) == name:
+            return self.node_at(index)
+        return None
+
+    def select_node(self, index):
+        if self.snapshot is None:
+            return BinaryTree.select_node(self, index)
+        if index < 0:
+            index += self.element_count
+        if not 0 <= index < self.element_count:
+            raise IndexError("tree index out of range")
+        return self.node_at(index)
+
+    def __contains__(self, value):
+        if self.snapshot is None:
+            return BinaryTree.__contains__(self, value)
+        if self.snapshot.has_names:
+            # snapshot names are all strings, so no element matches an unnamed lookup
+            return False
+        sort_key = value if self.key is None else self.key(value)
+        index = self.bisect(sort_key, None, False)
+        return index < self.snapshot.count and self.sort_key_at(index) == sort_key
+
+    def rank(self, value, name=None):
+        if self.snapshot is None:
+            return BinaryTree.rank(self, value, name)
+        return self.bisect(value if self.key is None else self.key(value), name, False)
+
+    def count_below(self, value, inclusive):
+        if self.snapshot is None:
+            return BinaryTree.count_below(self, value, inclusive)
+        return self.bisect(value if self.key is None else self.key(value), None, inclusive)
+
+    def item_or_none(self, index):
+        return self.item_at(index) if 0 <= index < self.element_count else None
+
+    def floor(self, value):
+        if self.snapshot is None:
+            return BinaryTree.floor(self, value)
+        return self.item_or_none(self.bisect(value if self.key is None else self.key(value), None, True) - 1)
+
+    def ceiling(self, value):
+        if self.snapshot is None:
+            return BinaryTree.ceiling(self, value)
+        return self.item_or_none(self.bisect(value if self.key is None else self.key(value), None, False))
+
+    def lower(self, value):
+        if self.snapshot is None:
+            return BinaryTree.lower(self, value)
+        return self.item_or_none(self.bisect(value if self.key is None else self.key(value), None, False) - 1)
+
+    def higher(self, value):
+        if self.snapshot is None:
+            return BinaryTree.higher(self, value)
+        return self.item_or_none(self.bisect(value if self.key is None else self.key(value), None, True))
+
+    def nearest(self, value):
+        if self.snapshot is None:
+            return BinaryTree.nearest(self, value)
+        nearest = self.k_nearest(value, 1)
+        return nearest[0] if nearest else None
+
+    def k_nearest(self, value, k):
+        if self.snapshot is None:
+            return BinaryTree.k_nearest(self, value, k)
+        sort_key = value if self.key is None else self.key(value)
+        above = self.bisect(sort_key, None, True)
+        below = above - 1
+        nearest = []
+        while len(nearest) < k and (below >= 0 or above < self.element_count):
+            if below < 0 or (above < self.element_count and
+                             self.sort_key_at(above) - sort_key < sort_key - self.sort_key_at(below)):
+                nearest.append(self.item_at(above))
+                above += 1
+            else:
+                nearest.append(self.item_at(below))
+                below -= 1
+        return nearest
+
+    def select(self, index):
+        if self.snapshot is None:
+            return BinaryTree.select(self, index)
+        if index < 0:
+            index += self.element_count
+        if not 0 <= index < self.element_count:
+            raise IndexError("tree index out of range")
+        return self.item_at(index)
+
+    def percentile(self, percent):
+        if self.snapshot is None:
+            return BinaryTree.percentile(self, percent)
+        self.check_percent(percent)
+        return self.snapshot.value(self.percentile_index(percent)) if self.element_count else None
+
+    def __getitem__(self, index):
+        if self.snapshot is None or not isinstance(index, slice):
+            return BinaryTree.__getitem__(self, index)
+        return [self.item_at(i) for i in range(*index.indices(self.element_count))]
+
+    def get_min(self):
+        if self.snapshot is None:
+            return BinaryTree.get_min(self)
+        return self.item_at(0) if self.element_count else None
+
+    def get_max(self):
+        if self.snapshot is None:
+            return BinaryTree.get_max(self)
+        return self.item_at(self.element_count - 1) if self.element_count else None
+
+    def height(self):
+        if self.snapshot is None:
+            return BinaryTree.height(self)
+        return max(0, self.element_count.bit_length() - 1)
+
+    def irange(self, low=None, high=None, inclusive=(True, True), reverse=False, with_names=False):
+        if self.snapshot is None:
+            return BinaryTree.irange(self, low, high, inclusive, reverse, with_names)
+        start = 0 if low is None else self.bisect(low if self.key is None else self.key(low), None, not inclusive[0])
+        stop = self.element_count if high is None else self.bisect(high if self.key is None else self.key(high),
+                                                                   None, inclusive[1])
+        return self.iterate_positions(start, stop, reverse, with_names)
+
+    def islice(self, start=None, stop=None, reverse=False, with_names=False):
+        if self.snapshot is None:
+            return BinaryTree.islice(self, start, stop, reverse, with_names)
+        start, stop, _ = slice(start, stop).indices(self.element_count)
+        return self.iterate_positions(start, stop, reverse, with_names)
+
+    def iterate_positions(self, start, stop, reverse, with_names):
+        """ Lazily Yield Elements At Positions start To stop, Unpacking SNAPSHOT_CHUNK At A Time
+        """
+        snapshot = self.snapshot
+        chunks = range(start, stop, SNAPSHOT_CHUNK)
+        for chunk_start in (reversed(chunks) if reverse else chunks):
+            chunk_stop = min(chunk_start + SNAPSHOT_CHUNK, stop)
+            values = snapshot.values(chunk_start, chunk_stop)
+            if with_names:
+                names = snapshot.names(chunk_start, chunk_stop) or [None] * len(values)
+                values = list(zip(values, names))
+            for value in (reversed(values) if reverse else values):
+                yield value
+
+    def as_list(self, pre_in_post):
+        if self.snapshot is None:
+            return BinaryTree.as_list(self, pre_in_post)
+        if pre_in_post in (1, 3):
+            return [self.item_at(i) for i in range(self.element_count)]
+        retlst = []
+        self.implicit_order(0, self.element_count, pre_in_post, retlst)
+        return retlst
+
+    def implicit_order(self, low, high, pre_in_post, retlst):
+        """ Append Positions low To high In Preorder (0) Or Postorder (2) Of The Implicit Balanced Tree
+        """
+        if low >= high:
+            return
+        middle = (low + high) // 2
+        if pre_in_post == 0:
+            retlst.append(self.item_at(middle))
+        self.implicit_order(low, middle, pre_in_post, retlst)
+        self.implicit_order(middle + 1, high, pre_in_post, retlst)
+        if pre_in_post == 2:
+            retlst.append(self.item_at(middle))
+
+
+class Cursor(object):
+    """ A Position In A BinaryTree, Stepping Between Neighbouring Elements In Amortized O(1)
+    Removing the element under a cursor other than through the cursor leaves the cursor undefined
+    """
+    def __init__(self, tree, node=None):
+        self.tree = tree
+        self.node = node
+
+    def current(self):
+        if self.node is None:
+            raise IndexError("cursor is not on an element")
+        return self.node
+
+    @property
+    def valid(self):
+        return self.node is not None
+
+    @property
+    def value(self):
+        return self.current().value
+
+    @property
+    def name(self):
+        return self.current().name
+
+    def seek(self, value, name=None):
+        """ Move To The First Element At Or After (value, name), Returns Whether There Is One
+        """
+        self.node = self.tree.seek_node(value, name)
+        return self.node is not None
+
+    def seek_first(self):
+        self.node = self.tree.min_node()
+        return self.node is not None
+
+    def seek_last(self):
+        self.node = self.tree.max_node()
+        return self.node is not None
+
+    def next(self):
+        """ Step To The Next Element, Returns Whether There Is One
+        """
+        self.node = self.current().next()
+        return self.node is not None
+
+    def prev(self):
+        """ Step To The Previous Element, Returns Whether There Is One
+        """
+        self.node = self.current().previous()
+        return self.node is not None
+
+    def remove(self):
+        """ Remove The Element Under The Cursor And Step To The Next One
+        """
+        node = self.current()
+        self.node = node.next()
+        self.tree.remove_node(node)
+
+    def insert(self, value, name=None):
+        """ Insert (value, name) Searching From The Cursor, Then Move Onto It
+        Stays put if the tree turns the element away, as a full TopKTree does
+        """
+        self.move_onto(self.tree.insert_near(self.node, value, name))
+
+    def insert_before(self, value, name=None):
+        """ Insert (value, name) Just Before The Current Element Without Searching, Then Move Onto It
+        Raises ValueError if it does not order between the current element and the one before it
+        """
+        self.move_onto(self.tree.insert_beside(self.current(), value, name, after=False))
+
+    def insert_after(self, value, name=None):
+        """ Insert (value, name) Just After The Current Element Without Searching, Then Move Onto It
+        Raises ValueError if it does not order between the current element and the one after it
+        """
+        self.move_onto(self.tree.insert_beside(self.current(), value, name, after=True))
+
+    def move_onto(self, node):
+        if node is not None:
+            self.node = node
+
+
+class MapNode(Node):
+    """ Node With A payload, The Value A TreeMap Maps The Node's Key To
+    """
+    __slots__ = ('payload',)
+
+    def __init__(self, value, name=None):
+        # Node.__init__ inlined, this runs once per TreeMap insert
+        self.value = value
+        self.name = name
+        self.sort_key = value
+        self.parent = None
+        self.left_child = None
+        self.right_child = None
+        self.height = 0
+        self.size = 1
+        self.payload = None
+
+
+class TreeMap(BinaryTree):
+    """ Sorted Map Whose Values Live On The Tree's Nodes
+    Keys are ordered, and unique, by key(k) as BinaryTree values are; names are not used
+    Lookups and updates take a single O(log n) descent
+    """
+    node_class = MapNode
+
+    def __init__(self, items=None, key=None):
+        BinaryTree.__init__(self, key=key)
+        if items is not None:
+            if hasattr(items, "items"):
+                items = items.items()
+            items = sorted(items, key=lambda item: item[0] if key is None else key(item[0]))
+            # of repeated keys the last one wins, as in dict(items)
+            kept = []
+            previous = None
+            for item in items:
+                sort_key = item[0] if key is None else key(item[0])
+                if kept and previous == sort_key:
+                    kept[-1] = item
+                else:
+                    kept.append(item)
+                previous = sort_key
+            self.build_from_sorted([k for k, _ in kept])
+            for node, (_, payload) in zip(self.in_order_nodes(), kept):
+                node.payload = payload
+
+    def node_for(self, key):
+        """ Return The Node Holding key, Or None
+        """
+        sort_key = key if self.key is None else self.key(key)
+        node = self.root
+        while node is not None:
+            node_key = node.sort_key
+            if sort_key < node_key:
+                node = node.left_child
+            elif node_key < sort_key:
+                node = node.right_child
+            else:
+                return node
+        return None
+
+    def __contains__(self, key):
+        return self.node_for(key) is not None
+
+    def __getitem__(self, key):
+        node = self.node_for(key)
+        if node is None:
+            raise KeyError(key)
+        return node.payload
+
+    def __setitem__(self, key, payload):
+        sort_key = key if self.key is None else self.key(key)
+        self.insert_in_subtree(self.root, key, None, sort_key).payload = payload
+
+    def insert(self, key, payload):
+        """ Map key To payload, As m[key] = payload Does; A Value Is Required
+        """
+        self[key] = payload
+
+    def insert_many(self, items):
+        """ Map Each key To Its payload For Every (key, payload) In items, Or In A Mapping's items()
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        for key, payload in items:
+            self[key] = payload
+
+    def __delitem__(self, key):
+        node = self.node_for(key)
+        if node is None:
+            raise KeyError(key)
+        self.remove_node(node)
+
+    def get(self, key, default=None):
+        node = self.node_for(key)
+        return default if node is None else node.payload
+
+    def setdefault(self, key, default=None):
+        sort_key = key if self.key is None else self.key(key)
+        count = self.element_count
+        node = self.insert_in_subtree(self.root, key, None, sort_key)
+        if self.element_count != count:
+            node.payload = default
+        return node.payload
+
+    def pop(self, key, *default):
+        node = self.node_for(key)
+        if node is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.remove_node(node)
+        return node.payload
+
+    def popitem(self, last=True):
+        """ Remove And Return The (key, value) Pair With The Largest Key, Or The Smallest If Not last
+        """
+        node = self.max_node() if last else self.min_node()
+        if node is None:
+            raise KeyError("popitem(): tree map is empty")
+        self.remove_node(node)
+        return node.value, node.payload
+
+    def keys(self, low=None, high=None, inclusive=(True, True)):
+        """ Return A Lazy View Of The Keys, Or Of Those Between low And high
+        """
+        return TreeMapView(self, "keys", low, high, inclusive)
+
+    def values(self, low=None, high=None, inclusive=(True, True)):
+        return TreeMapView(self, "values", low, high, inclusive)
+
+    def items(self, low=None, high=None, inclusive=(True, True)):
+        return TreeMapView(self, "items", low, high, inclusive)
+
+
+class TreeMapView(object):
+    """ Lazy View Of A TreeMap's Keys, Values Or Items Whose Keys Lie Between low And high
+    Like a dict view it reflects later changes to the map. A bound of None leaves that end open
+    Supports len(), iteration, reversed(), in, and indexing or slicing by position within the range
+    """
+    def __init__(self, tree_map, kind, low=None, high=None, inclusive=(True, True)):
+        self.tree_map = tree_map
+        self.kind = kind
+        self.low = low
+        self.high = high
+        self.inclusive = inclusive
+
+    def entry(self, node):
+        if self.kind == "keys":
+            return node.value
+        elif self.kind == "values":
+            return node.payload
+        return node.value, node.payload
+
+    def __iter__(self):
+        for node in self.tree_map.irange_nodes(self.low, self.high, self.inclusive):
+            yield self.entry(node)
+
+    def __reversed__(self):
+        for node in self.tree_map.irange_nodes(self.low, self.high, self.inclusive, reverse=True):
+            yield self.entry(node)
+
+    def offset(self):
+        """ Return The Number Of Keys Before The Range
+        """
+        return 0 if self.low is None else self.tree_map.count_below(self.low, not self.inclusive[0])
+
+    def __len__(self):
+        below_high = len(self.tree_map) if self.high is None else self.tree_map.count_below(self.high, self.inclusive[1])
+        return max(0, below_high - self.offset())
+
+    def in_range(self, node):
+        key = self.tree_map.key
+        if self.low is not None:
+            low_key = self.low if key is None else key(self.low)
+            if node.sort_key < low_key or (not self.inclusive[0] and node.sort_key == low_key):
+                return False
+        if self.high is not None:
+            high_key = self.high if key is None else key(self.high)
+            if high_key < node.sort_key or (not self.inclusive[1] and node.sort_key == high_key):
+                return False
+        return True
+
+    def __contains__(self, entry):
+        if self.kind == "values":
+            return any(payload == entry for payload in self)
+        node = self.tree_map.node_for(entry if self.kind == "keys" else entry[0])
+        if node is None or not self.in_range(node):
+            return False
+        return self.kind == "keys" or node.payload == entry[1]
+
+    def __getitem__(self, index):
+        count = len(self)
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(count))]
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError("view index out of range")
+        return self.entry(self.tree_map.select_node(self.offset() + index))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.kind, list(self))
+
+
+class CountedNode(Node):
+    """ Node Holding count Occurrences Of Its Value, total Is The Number Of Occurrences In Its Subtree
+    """
+    __slots__ = ('count', 'total')
+
+    def __init__(self, value, name=None):
+        # Node.__init__ inlined, this runs once per new distinct value
+        self.value = value
+        self.name = name
+        self.sort_key = value
+        self.parent = None
+        self.left_child = None
+        self.right_child = None
+        self.height = 0
+        self.size = 1
+        self.count = 1
+        self.total = 1
+
+    def refresh(self):
+        Node.refresh(self)
+        left = self.left_child
+        right = self.right_child
+        self.total = self.count + (left.total if left is not None else 0) + (right.total if right is not None else 0)
+
+
+class MultisetTree(BinaryTree):
+    """ Sorted Multiset Storing Each Distinct Value Once With A Count, So Memory Grows With Distinct Values
+    len(), iteration, rank and positions count every occurrence; names are not used
+    insert() adds an occurrence as add() does, remove() drops every occurrence of a value
+    union() adds counts, intersection() keeps the smaller count and difference() subtracts counts
+    """
+    node_class = CountedNode
+
+    def __len__(self):
+        return self.root.total if self.root is not None else 0
+
+    def make_nodes(self, values, names=None):
+        """ Return Unlinked Nodes For The Sorted values, One Per Distinct Value, Counting Repeats
+        """
+        nodes = []
+        previous = None
+        for value in values:
+            sort_key = value if self.key is None else self.key(value)
+            if previous is not None and previous.sort_key == sort_key:
+                previous.count += 1
+                continue
+            previous = self.node_class(value)
+            previous.sort_key = sort_key
+            nodes.append(previous)
+        return nodes
+
+    def absorb(self, node, duplicate):
+        node.count += duplicate.count
+
+    def intersect(self, node, duplicate):
+        node.count = min(node.count, duplicate.count)
+
+    def subtract(self, node, duplicate):
+        node.count -= duplicate.count
+        return node.count > 0
+
+    def pop_node(self, node):
+        """ Remove One Occurrence Of node's Value And Return It
+        """
+        if node.count > 1:
+            node.count -= 1
+            self.adjust_sizes(node, 0)
+            return self.element(node)
+        return BinaryTree.pop_node(self, node)
+
+    def adjust_sizes(self, node, delta):
+        """ Add delta To The Subtree Size Of node And Its Ancestors, And Recount Their Occurrence Totals
+        """
+        while node is not None:
+            node.size += delta
+            left = node.left_child
+            right = node.right_child
+            node.total = node.count + (left.total if left is not None else 0) + (right.total if right is not None else 0)
+            node = node.parent
+
+    def insert_in_subtree(self, node, value, name, sort_key):
+        count = self.element_count
+        found = BinaryTree.insert_in_subtree(self, node, value, None, sort_key)
+        if self.element_count == count:
+            found.count += 1
+            self.adjust_sizes(found, 0)
+        return found
+
+    def add(self, value, occurrences=1):
+        """ Add occurrences Of value, In One O(log n) Descent
+        """
+        if occurrences < 1:
+            raise ValueError("occurrences must be at least 1")
+        sort_key = value if self.key is None else self.key(value)
+        node = self.insert_in_subtree(self.root, value, None, sort_key)
+        if occurrences != 1:
+            node.count += occurrences - 1
+            self.adjust_sizes(node, 0)
+
+    def discard(self, value, occurrences=1):
+        """ Remove Up To occurrences Of value, If Present
+        """
+        if occurrences < 1:
+            raise ValueError("occurrences must be at least 1")
+        node = self.find(value)
+        if node is None:
+            return
+        if node.count > occurrences:
+            node.count -= occurrences
+            self.adjust_sizes(node, 0)
+        else:
+            self.remove_node(node)
+
+    def count(self, value):
+        node = self.find(value)
+        return node.count if node is not None else 0
+
+    def items(self):
+        """ Lazily Yield (value, count) For Each Distinct Value In Order
+        """
+        for node in self.irange_nodes():
+            yield node.value, node.count
+
+    def irange(self, low=None, high=None, inclusive=(True, True), reverse=False, with_names=False):
+        for node in self.irange_nodes(low, high, inclusive, reverse):
+            for _ in range(node.count):
+                yield (node.value, node.name) if with_names else node.value
+
+    def islice(self, start=None, stop=None, reverse=False, with_names=False):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return
+        node, offset = self.locate(stop - 1 if reverse else start)
+        remaining = stop - start
+        while True:
+            run = min(remaining, offset + 1 if reverse else node.count - offset)
+            for _ in range(run):
+                yield (node.value, node.name) if with_names else node.value
+            remaining -= run
+            if remaining == 0:
+                return
+            node = node.previous() if reverse else node.next()
+            offset = node.count - 1 if reverse else 0
+
+    def k_nearest(self, value, k):
+        """ Return Up To k Occurrences Whose Keys Are Closest To value's, Closest First, Lower First On A Tie
+        Each copy of a value counts toward k
+        """
+        sort_key = value if self.key is None else self.key(value)
+        below = self.last_node_to(value, True)
+        above = below.next() if below is not None else self.min_node()
+        nearest = []
+        while len(nearest) < k and (below is not None or above is not None):
+            if below is None or (above is not None and above.sort_key - sort_key < sort_key - below.sort_key):
+                node = above
+                above = above.next()
+            else:
+                node = below
+                below = below.previous()
+            nearest.extend([node.value] * min(node.count, k - len(nearest)))
+        return nearest
+
+    def rank(self, value, name=None):
+        """ Return Number Of Occurrences Of Values Whose Key Is Less Than value's
+        """
+        return self.count_below(value, False)
+
+    def count_below(self, value, inclusive):
+        sort_key = value if self.key is None else self.key(value)
+        count = 0
+        node = self.root
+        while node is not None:
+            if sort_key < node.sort_key or (not inclusive and sort_key == node.sort_key):
+                node = node.left_child
+            else:
+                count += (node.left_child.total if node.left_child else 0) + node.count
+                node = node.right_child
+        return count
+
+    def locate(self, index):
+        """ Return (Node, Offset Within Its Occurrences) Of The Occurrence At Position index
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("tree index out of range")
+        node = self.root
+        while True:
+            left_total = node.left_child.total if node.left_child else 0
+            if index < left_total:
+                node = node.left_child
+            elif index < left_total + node.count:
+                return node, index - left_total
+            else:
+                index -= left_total + node.count
+                node = node.right_child
+
+    def select_node(self, index):
+        return self.locate(index)[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.select(index)
+        return [self.select(i) for i in range(*index.indices(len(self)))]
+
+
+AGGREGATES = {
+    # name: (combine, identity, measure), measure None aggregates the values themselves
+    "sum": (operator.add, 0, None),
+    "count": (operator.add, 0, lambda value: 1),
+    "min": (min, float("inf"), None),
+    "max": (max, float("-inf"), None),
+}
+
+
+def aggregate_node_class(combine, identity, measure):
+    """ Return A Node Subclass That Keeps combine() Of measure(value) Over Its Subtree, In Key Order
+    """
+    class AggregateNode(Node):
+        __slots__ = ('measured', 'aggregate')
+
+        def __init__(self, value, name=None):
+            Node.__init__(self, value, name)
+            self.measured = value if measure is None else measure(value)
+            self.aggregate = self.measured
+
+        def update_aggregate(self):
+            aggregate = self.measured
+            if self.left_child is not None:
+                aggregate = combine(self.left_child.aggregate, aggregate)
+            if self.right_child is not None:
+                aggregate = combine(aggregate, self.right_child.aggregate)
+            self.aggregate = aggregate
+
+        def refresh(self):
+            Node.refresh(self)
+            self.update_aggregate()
+
+    AggregateNode.combine = staticmethod(combine)
+    AggregateNode.identity = identity
+    AggregateNode.signature = (combine, identity, measure)
+    return AggregateNode
+
+
+class AggregateTree(BinaryTree):
+    """ BinaryTree Whose Nodes Keep An Aggregate Of Their Subtree, What BinaryTree(aggregate=...) Builds
+    aggregate is "sum", "count", "min", "max", or (combine, identity) or (combine, identity, measure) for an
+    associative combine(a, b) over measure(value) (default: the value); combine need not be commutative.
+    Rotations recombine through Node.refresh() and every size adjustment recombines the path above it
+    """
+    def __init__(self, iterable=None, key=None, aggregate="sum"):
+        if aggregate in AGGREGATES:
+            aggregate = AGGREGATES[aggregate]
+        combine, identity = aggregate[:2]
+        self.node_class = aggregate_node_class(combine, identity, aggregate[2] if len(aggregate) > 2 else None)
+        BinaryTree.__init__(self, iterable, key)
+
+    def empty_like(self):
+        tree = BinaryTree.empty_like(self)
+        tree.node_class = self.node_class
+        return tree
+
+    def node_signature(self):
+        return self.node_class.signature
+
+    def adjust_sizes(self, node, delta):
+        """ Add delta To The Subtree Size Of node And Its Ancestors, And Recombine Their Aggregates
+        """
+        combine = self.node_class.combine
+        while node is not None:
+            node.size += delta
+            # update_aggregate() inlined, this runs for every ancestor of every insert and remove
+            aggregate = node.measured
+            if node.left_child is not None:
+                aggregate = combine(node.left_child.aggregate, aggregate)
+            if node.right_child is not None:
+                aggregate = combine(aggregate, node.right_child.aggregate)
+            node.aggregate = aggregate
+            node = node.parent
+
+    def aggregate_range(self, low=None, high=None, inclusive=(True, True)):
+        """ Return The Aggregate Over The Elements Whose Keys Lie Between low And high, In O(log n)
+        A bound of None leaves that end open; an empty range gives the identity
+        """
+        node = self.root
+        if low is None and high is None:
+            return node.aggregate if node is not None else self.node_class.identity
+        low_key = None if low is None else (low if self.key is None else self.key(low))
+        high_key = None if high is None else (high if self.key is None else self.key(high))
+        # descend to the top node inside the range, both bounds' paths continue below it
+        while node is not None:
+            if self.below(node, low_key, inclusive[0]):
+                node = node.right_child
+            elif self.above(node, high_key, inclusive[1]):
+                node = node.left_child
+            else:
+                break
+        if node is None:
+            return self.node_class.identity
+        combine = self.node_class.combine
+        return combine(combine(self.aggregate_from(node.left_child, low_key, inclusive[0]), node.measured),
+                       self.aggregate_to(node.right_child, high_key, inclusive[1]))
+
+    def below(self, node, low_key, inclusive):
+        return low_key is not None and (node.sort_key < low_key or (not inclusive and node.sort_key == low_key))
+
+    def above(self, node, high_key, inclusive):
+        return high_key is not None and (high_key < node.sort_key or (not inclusive and node.sort_key == high_key))
+
+    def aggregate_from(self, node, low_key, inclusive):
+        """ Aggregate Of The Subtree node Over Keys From low_key Up
+        """
+        combine = self.node_class.combine
+        aggregate = self.node_class.identity
+        while node is not None:
+            if self.below(node, low_key, inclusive):
+                node = node.right_child
+            else:
+                if node.right_child is not None:
+                    aggregate = combine(node.right_child.aggregate, aggregate)
+                aggregate = combine(node.measured, aggregate)
+                node = node.left_child
+        return aggregate
+
+    def aggregate_to(self, node, high_key, inclusive):
+        """ Aggregate Of The Subtree node Over Keys Up To high_key
+        """
+        combine = self.node_class.combine
+        aggregate = self.node_class.identity
+        while node is not None:
+            if self.above(node, high_key, inclusive):
+                node = node.left_child
+            else:
+                if node.left_child is not None:
+                    aggregate = combine(aggregate, node.left_child.aggregate)
+                aggregate = combine(aggregate, node.measured)
+                node = node.right_child
+        return aggregate
+
+
+class IntervalTree(AggregateTree):
+    """ Tree Of (start, end) Intervals Ordered By start (Then end), Each Node Keeping The Largest end Below It
+    Intervals are closed; use names to keep several copies of an identical interval.
+    key is accepted for the BinaryTree methods that build trees, but must be None: the queries rely on this order
+    """
+    END_AGGREGATE = (max, float("-inf"), operator.itemgetter(1))  # largest end, shared so interval trees combine
+
+    def __init__(self, intervals=None, key=None):
+        if key is not None:
+            raise ValueError("intervals are ordered by (start, end), key must be None")
+        AggregateTree.__init__(self, intervals, None, self.END_AGGREGATE)
+
+    def overlapping(self, low, high):
+        """ Lazily Yield The Intervals Overlapping [low, high] In Order Of start, In O(log n + k log(n/k)) For k Found
+        Subtrees whose largest end is before low are skipped, and the walk stops at the first start after high;
+        between two matches it may still descend into subtrees that hold none, so it is not O(log n + k)
+        """
+        stack = []
+        node = self.root
+        while True:
+            while node is not None and node.aggregate >= low:
+                stack.append(node)
+                node = node.left_child
+            if not stack:
+                return
+            node = stack.pop()
+            if high < node.value[0]:
+                return
+            if node.measured >= low:
+                yield node.value
+            node = node.right_child
+
+    def stabbing(self, point):
+        """ Lazily Yield The Intervals Containing point
+        """
+        return self.overlapping(point, point)
+
+
+class TopKTree(BinaryTree):
+    """ BinaryTree Holding Only The capacity Largest (Or Smallest, With keep="smallest") Elements Offered
+    What BinaryTree(capacity=K, keep=...) builds. Once full, an element no better than the boundary (the cached
+    leftmost node when keeping the largest) is turned away in O(1); a better one is inserted and the boundary
+    node unlinked in O(log n). Ties with the boundary are turned away, so earlier elements keep their place.
+    Finger, cursor and beside inserts make the same check before linking anything and return None for an element
+    turned away (a cursor stays put); split, join and set operations trim back to capacity
+    """
+    def __init__(self, iterable=None, key=None, capacity=None, keep="largest"):
+        if capacity is None or capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if keep not in ("largest", "smallest"):
+            raise ValueError("keep must be 'largest' or 'smallest'")
+        BinaryTree.__init__(self, key=key)
+        self.capacity = capacity
+        self.keep_largest = keep == "largest"
+        if iterable is not None:
+            self.insert_many(iterable)
+
+    @classmethod
+    def from_sorted(cls, values, names=None, key=None, capacity=None, keep="largest"):
+        """ Return A New Tree Of The capacity Best values (With The Parallel names, If Given)
+        Ascending values are offered best first, so all but capacity of them are turned away in O(1)
+        """
+        tree = cls(key=key, capacity=capacity, keep=keep)
+        if tree.keep_largest:
+            values = list(values)[::-1]
+            names = None if names is None else list(names)[::-1]
+        tree.insert_many(values, names)
+        return tree
+
+    @classmethod
+    def load(cls, path, mmap=True, key=None, capacity=None, keep="largest"):
+        """ Return A New Tree Of The capacity Best Elements Of A Snapshot Written By save()
+        """
+        if mmap:
+            raise TypeError("only BinaryTree snapshots can be mapped, load %s with mmap=False" % cls.__name__)
+        snapshot = SnapshotFile(path)
+        try:
+            values, names = snapshot.values(0, snapshot.count), snapshot.names(0, snapshot.count)
+        finally:
+            snapshot.close()
+        return cls.from_sorted(values, names, key, capacity, keep)
+
+    def empty_like(self):
+        return self.__class__(key=self.key, capacity=self.capacity, keep="largest" if self.keep_largest else "smallest")
+
+    def admits(self, sort_key):
+        """ Whether An Element With sort_key Would Be Kept: There Is Room, Or It Beats The Boundary
+        """
+        if self.element_count < self.capacity:
+            return True
+        boundary_key = self.boundary().sort_key
+        return boundary_key < sort_key if self.keep_largest else sort_key < boundary_key
+
+    def trim(self):
+        """ Unlink Boundary Nodes Until At Most capacity Remain
+        """
+        while self.element_count > self.capacity:
+            self.remove_node(self.boundary())
+
+    def insert_in_subtree(self, node, value, name, sort_key):
+        """ Insert As BinaryTree Does If The Element Is Admitted, Then Trim; Returns None If It Was Turned Away
+        """
+        if not self.admits(sort_key):
+            return None
+        found = BinaryTree.insert_in_subtree(self, node, value, name, sort_key)
+        self.trim()
+        return found
+
+    def insert_beside(self, node, value, name=None, after=True):
+        if not self.admits(value if self.key is None else self.key(value)):
+            return None
+        found = BinaryTree.insert_beside(self, node, value, name, after)
+        self.trim()
+        return found
+
+    def adopt(self, root):
+        BinaryTree.adopt(self, root)
+        self.trim()
+
+    def boundary(self):
+        """ Return The Node That Goes Next: The Smallest Kept When Keeping The Largest, Else The Largest
+        """
+        return self.leftmost if self.keep_largest else self.rightmost
+
+    def threshold(self):
+        """ Return The Element A New One Must Beat Once The Tree Is Full, Or None While It Is Not
+        """
+        if self.element_count < self.capacity:
+            return None
+        return self.element(self.boundary())
+
+    def insert(self, value, name=None):
+        """ Offer (value, name), Returns Whether It Is Now Kept
+        """
+        sort_key = value if self.key is None else self.key(value)
+        return self.insert_in_subtree(self.root, value, name, sort_key) is not None
+
+    def insert_many(self, values, names=None):
+        """ Offer Every Value (With The Parallel names, If Given) In Turn, Holding At Most capacity Nodes
+        The boundary key is held in a local between admissions, so a rejection costs one comparison
+        """
+        pairs = ((value, None) for value in values) if names is None else zip(values, names)
+        key = self.key
+        largest = self.keep_largest
+        limit = None
+        for value, name in pairs:
+            if limit is not None:
+                sort_key = value if key is None else key(value)
+                if not (limit < sort_key if largest else sort_key < limit):
+                    continue
+            if self.insert(value, name) and self.element_count >= self.capacity:
+                limit = self.boundary().sort_key
+
+    def ranked(self, with_names=False):
+        """ Lazily Yield The Kept Elements Best First: Largest First When Keeping The Largest
+        """
+        return self.irange(reverse=self.keep_largest, with_names=with_names)
+
+
+class SlidingWindowTree(BinaryTree):
+    """ BinaryTree Over The Last window_size Values Added, Or Those Added In The Last window_seconds
+    Each value is stored with a sequence number as its name, so equal values stay distinct, and expires by handle:
+    the nodes are queued in arrival order and the oldest are unlinked with remove_node(), without a search.
+    Lookups take and return bare values whatever the sequence number. Timestamps passed in must not decrease.
+    Every removal also drops the value's queued arrival; the nodes belong to that queue, so the window cannot
+    be split, joined or combined, and values enter only through add() (insert() and insert_many() call it)
+    """
+    def __init__(self, window_size=None, window_seconds=None, key=None, clock=time.time):
+        if (window_size is None) == (window_seconds is None):
+            raise ValueError("give exactly one of window_size and window_seconds")
+        BinaryTree.__init__(self, key=key)
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.arrivals = collections.deque()  # (timestamp, node), oldest first
+        self.sequence = 0
+
+    def element(self, node):
+        return node.value if node is not None else None
+
+    def __contains__(self, value):
+        return self.find(value) is not None
+
+    def find(self, value, name=None):
+        """ Return The Oldest-Ordered Node Holding value, Or With A name The Node For That Sequence Number
+        """
+        if name is not None:
+            return BinaryTree.find(self, value, name)
+        node = self.first_node_from(value, True)
+        sort_key = value if self.key is None else self.key(value)
+        return node if node is not None and node.sort_key == sort_key else None
+
+    def remove(self, key, name=None):
+        """ Remove One Copy Of key, As find() Picks It
+        """
+        node = self.find(key, name)
+        if node is not None:
+            self.remove_node(node)
+
+    def remove_many(self, values):
+        for value in values:
+            self.remove(value)
+
+    def remove_node(self, node):
+        """ Unlink node And Drop Its Arrival, O(1) For The Oldest As expire() Removes, O(n) From Elsewhere
+        """
+        arrivals = self.arrivals
+        if arrivals[0][1] is node:
+            arrivals.popleft()
+        else:
+            for index, (_, queued) in enumerate(arrivals):
+                if queued is node:
+                    del arrivals[index]
+                    break
+        BinaryTree.remove_node(self, node)
+
+    def insert(self, value, name=None):
+        """ Add value As add() Does; The Window Names Its Values Itself
+        """
+        if name is not None:
+            raise ValueError("a sliding window numbers its values, name must be None")
+        self.add(value)
+
+    def insert_many(self, values, names=None):
+        if names is not None:
+            raise ValueError("a sliding window numbers its values, names must be None")
+        self.extend(values)
+
+    def insert_near(self, finger, value, name=None):
+        raise TypeError("a sliding window only takes values through add(), insert() or extend()")
+
+    def insert_beside(self, node, value, name=None, after=True):
+        raise TypeError("a sliding window only takes values through add(), insert() or extend()")
+
+    def empty_like(self):
+        raise TypeError("a sliding window's nodes belong to its arrival queue, it cannot be split or combined")
+
+    def node_signature(self):
+        # unique to this window, so no other tree accepts its nodes
+        return self
+
+    def push(self, value, timestamp):
+        sort_key = value if self.key is None else self.key(value)
+        self.arrivals.append((timestamp, self.insert_in_subtree(self.root, value, self.sequence, sort_key)))
+        self.sequence += 1
+
+    def expire(self, now=None):
+        """ Evict What Has Left The Window; Time Windows Measure From now, Or The Clock
+        """
+        arrivals = self.arrivals
+        if self.window_size is not None:
+            while len(arrivals) > self.window_size:
+                self.remove_node(arrivals[0][1])
+        else:
+            cutoff = (self.clock() if now is None else now) - self.window_seconds
+            while arrivals and arrivals[0][0] <= cutoff:
+                self.remove_node(arrivals[0][1])
+
+    def add(self, value, timestamp=None):
+        if timestamp is None and self.window_seconds is not None:
+            timestamp = self.clock()
+        self.push(value, timestamp)
+        self.expire(timestamp)
+
+    def extend(self, values, timestamped=False, batch=1024):
+        """ Add Every Value, Evicting Once Per Micro-Batch Of batch Values
+        With timestamped, the items are (timestamp, value) pairs; otherwise a batch shares one clock reading
+        """
+        chunk = []
+        for item in values:
+            chunk.append(item)
+            if len(chunk) >= batch:
+                self.add_batch(chunk, timestamped)
+                chunk = []
+        if chunk:
+            self.add_batch(chunk, timestamped)
+
+    def add_batch(self, chunk, timestamped):
+        if self.window_size is not None and len(chunk) > self.window_size:
+            # the rest would be evicted straight away
+            chunk = chunk[-self.window_size:]
+        if timestamped:
+            for timestamp, value in chunk:
+                self.push(value, timestamp)
+            now = chunk[-1][0]
+        else:
+            now = self.clock() if self.window_seconds is not None else None
+            for value in chunk:
+                self.push(value, now)
+        self.expire(now)
+
+    def afeed(self, source, timestamped=False, batch=1024):
+        """ Return An Awaitable That Feeds The Async Iterator source Into The Window, Micro-Batched As extend() Does
+        Python 3 only: await window.afeed(source)
+        """
+        return WindowFeed(self, source, timestamped, batch)
+
+    def quantile(self, fraction):
+        """ Return The Value At fraction (0 To 1) Of The Window By The Nearest-Rank Method, In O(log n)
+        """
+        return self.percentile(fraction * 100)
+
+    def median(self):
+        return self.percentile(50)
+
+
+class WindowFeed(object):
+    """ Awaitable Returned By SlidingWindowTree.afeed(), Consuming An Async Iterator
+    Written as a plain generator that passes the event loop's messages through, so the module still parses
+    under Python 2
+    """
+    def __init__(self, window, source, timestamped, batch):
+        self.window = window
+        self.source = source
+        self.timestamped = timestamped
+        self.batch = batch
+
+    def __await__(self):
+        iterator = self.source.__aiter__()
+        chunk = []
+        while True:
+            try:
+                step = iterator.__anext__().__await__()
+                message = next(step)
+                while True:
+                    message = step.send((yield message))
+            except StopIteration as done:
+                chunk.append(done.value)
+            except StopAsyncIteration:
+                break
+            if len(chunk) >= self.batch:
+                self.window.add_batch(chunk, self.timestamped)
+                chunk = []
+        if chunk:
+            self.window.add_batch(chunk, self.timestamped)
+
+
+class PersistentNode(object):
+    """ Immutable Tree Node Without A Parent Pointer, So Versions Of A Tree Can Share Subtrees
+    Height and subtree size are computed from the children when it is created
+    """
+    __slots__ = ('value', 'name', 'sort_key', 'left_child', 'right_child', 'height', 'size')
+
+    def __init__(self, value, name, sort_key, left_child=None, right_child=None):
+        self.value = value
+        self.name = name
+        self.sort_key = sort_key
+        self.left_child = left_child
+        self.right_child = right_child
+        left_height = left_child.height if left_child is not None else -1
+        right_height = right_child.height if right_child is not None else -1
+        self.height = (left_height if left_height > right_height else right_height) + 1
+        self.size = 1 + (left_child.size if left_child is not None else 0) + (right_child.size if right_child is not None else 0)
+
+    def with_children(self, left_child, right_child):
+        """ Return A Copy Of This Node With Other Children
+        """
+        return PersistentNode(self.value, self.name, self.sort_key, left_child, right_child)
+
+    def weigh(self):
+        return (self.left_child.height if self.left_child is not None else -1) - \
+               (self.right_child.height if self.right_child is not None else -1)
+
+    def rotate_left(self):
+        """ Return A Copy Of This Subtree With The Left Child Promoted
+        """
+        left = self.left_child
+        return left.with_children(left.left_child, self.with_children(left.right_child, self.right_child))
+
+    def rotate_right(self):
+        """ Return A Copy Of This Subtree With The Right Child Promoted
+        """
+        right = self.right_child
+        return right.with_children(self.with_children(self.left_child, right.left_child), right.right_child)
+
+    def balance(self):
+        """ Return This Subtree, Or A Rebalanced Copy If Its Children's Heights Differ By 2
+        """
+        weight = self.weigh()
+        node = self
+        if weight > 1:
+            if node.left_child.weigh() < 0:
+                node = node.with_children(node.left_child.rotate_right(), node.right_child)
+            return node.rotate_left()
+        elif weight < -1:
+            if node.right_child.weigh() > 0:
+                node = node.with_children(node.left_child, node.right_child.rotate_left())
+            return node.rotate_right()
+        return node
+
+
+class PersistentBinaryTree(object):
+    """ AVL Tree Of Immutable Nodes, Where Every Version Stays Readable
+    A write copies only the O(log n) path it changes and shares the rest with the previous version, so
+    snapshot() is O(1) and an old version lives exactly as long as something still references it.
+    There are no parent pointers; writes keep the search path on a stack instead
+    """
+    def __init__(self, iterable=None, key=None):
+        self.key = key
+        self.root = None
+        if iterable is not None:
+            values = sorted(iterable, key=key)
+            nodes = []
+            for value in values:
+                sort_key = value if key is None else key(value)
+                if not nodes or nodes[-1][1] != sort_key:
+                    nodes.append((value, sort_key))
+            self.root = self.build(nodes, 0, len(nodes))
+
+    def build(self, nodes, low, high):
+        if low >= high:
+            return None
+        middle = (low + high) // 2
+        value, sort_key = nodes[middle]
+        return PersistentNode(value, None, sort_key, self.build(nodes, low, middle), self.build(nodes, middle + 1, high))
+
+    def __len__(self):
+        root = self.root
+        return root.size if root is not None else 0
+
+    def __contains__(self, value):
+        return self.find(value) is not None
+
+    def __iter__(self):
+        return self.irange()
+
+    def __reversed__(self):
+        return self.irange(reverse=True)
+
+    def height(self):
+        root = self.root
+        return root.height if root is not None else 0
+
+    def snapshot(self):
+        """ Return An Unchanging View Of The Current Version In O(1), Later Writes To Either Tree Do Not Affect The Other
+        """
+        tree = self.__class__(key=self.key)
+        tree.root = self.root
+        return tree
+
+    def insert(self, value, name=None):
+        sort_key = value if self.key is None else self.key(value)
+        self.root = self.inserted(self.root, value, name, sort_key)
+
+    def remove(self, value, name=None):
+        sort_key = value if self.key is None else self.key(value)
+        self.root = self.removed(self.root, sort_key, name)
+
+    def inserted(self, root, value, name, sort_key):
+        """ Return The Root Of A Version Of root With (value, name) Added
+        """
+        path = []
+        node = root
+        while node is not None:
+            key = node.sort_key
+            if sort_key < key:
+                is_left = True
+            elif key < sort_key:
+                is_left = False
+            elif name == node.name:
+                return root
+            else:
+                is_left = name < node.name
+            path.append((node, is_left))
+            node = node.left_child if is_left else node.right_child
+        return self.copy_path(path, PersistentNode(value, name, sort_key))
+
+    def removed(self, root, sort_key, name):
+        """ Return The Root Of A Version Of root Without (sort_key, name)
+        """
+        path = []
+        node = root
+        while node is not None:
+            key = node.sort_key
+            if sort_key < key:
+                is_left = True
+            elif key < sort_key:
+                is_left = False
+            elif name == node.name:
+                break
+            else:
+                is_left = name < node.name
+            path.append((node, is_left))
+            node = node.left_child if is_left else node.right_child
+        if node is None:
+            return root
+        if node.left_child is None:
+            replacement = node.right_child
+        elif node.right_child is None:
+            replacement = node.left_child
+        else:
+            right, successor = self.removed_first(node.right_child)
+            replacement = successor.with_children(node.left_child, right).balance()
+        return self.copy_path(path, replacement)
+
+    def removed_first(self, node):
+        """ Return (Subtree Without Its First Node, That First Node)
+        """
+        if node.left_child is None:
+            return node.right_child, node
+        left, first = self.removed_first(node.left_child)
+        return node.with_children(left, node.right_child).balance(), first
+
+    def copy_path(self, path, node):
+        """ Copy The Recorded Search path Bottom-Up Around The New Subtree node, Rebalancing, Returns The New Root
+        """
+        for parent, is_left in reversed(path):
+            if is_left:
+                left, right = node, parent.right_child
+            else:
+                left, right = parent.left_child, node
+            node = PersistentNode(parent.value, parent.name, parent.sort_key, left, right)
+            weight = (left.height if left is not None else -1) - (right.height if right is not None else -1)
+            if weight > 1 or weight < -1:
+                node = node.balance()
+        return node
+
+    def find(self, value, name=None):
+        sort_key = value if self.key is None else self.key(value)
+        node = self.root
+        while node is not None:
+            key = node.sort_key
+            if sort_key < key:
+                node = node.left_child
+            elif key < sort_key:
+                node = node.right_child
+            elif name == node.name:
+                return node
+            elif name < node.name:
+                node = node.left_child
+            else:
+                node = node.right_child
+        return None
+
+    def rank(self, value):
+        """ Return Number Of Elements Whose Key Is Less Than value's
+        """
+        sort_key = value if self.key is None else self.key(value)
+        rank = 0
+        node = self.root
+        while node is not None:
+            if node.sort_key < sort_key:
+                rank += (node.left_child.size if node.left_child is not None else 0) + 1
+                node = node.right_child
+            else:
+                node = node.left_child
+        return rank
+
+    def select(self, index):
+        """ Return The Value At Position index In Sorted Order, Negative Indexes Count From The End
+        """
+        node = self.root
+        count = node.size if node is not None else 0
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError("tree index out of range")
+        while True:
+            left_size = node.left_child.size if node.left_child is not None else 0
+            if index < left_size:
+                node = node.left_child
+            elif index == left_size:
+                return node.value
+            else:
+                index -= left_size + 1
+                node = node.right_child
+
+    def __getitem__(self, index):
+        return self.select(index)
+
+    def get_min(self):
+        node = self.root
+        if node is None:
+            return None
+        while node.left_child is not None:
+            node = node.left_child
+        return node.value
+
+    def get_max(self):
+        node = self.root
+        if node is None:
+            return None
+        while node.right_child is not None:
+            node = node.right_child
+        return node.value
+
+    def irange(self, low=None, high=None, inclusive=(True, True), reverse=False, with_names=False):
+        """ Lazily Yield Elements Whose Keys Lie Between low And high, From The Version Current At The Call
+        A bound of None leaves that end open. Yields bare values, or (value, name) tuples with with_names
+        Keeps an O(log n) stack instead of parent pointers
+        """
+        low_key = None if low is None else (low if self.key is None else self.key(low))
+        high_key = None if high is None else (high if self.key is None else self.key(high))
+        return self.iterate(self.root, low_key, high_key, inclusive, reverse, with_names)
+
+    def iterate(self, root, low_key, high_key, inclusive, reverse, with_names):
+        if reverse:
+            start_key, start_inclusive, stop_key, stop_inclusive = high_key, inclusive[1], low_key, inclusive[0]
+        else:
+            start_key, start_inclusive, stop_key, stop_inclusive = low_key, inclusive[0], high_key, inclusive[1]
+        # stack the ancestors still to be visited, seeking past everything before the start bound
+        stack = []
+        node = root
+        while node is not None:
+            if start_key is None or (node.sort_key < start_key if reverse else start_key < node.sort_key) or \
+                    (start_inclusive and node.sort_key == start_key):
+                stack.append(node)
+                node = node.right_child if reverse else node.left_child
+            else:
+                node = node.left_child if reverse else node.right_child
+        while stack:
+            node = stack.pop()
+            if stop_key is not None and ((stop_key < node.sort_key if not reverse else node.sort_key < stop_key) or
+                                         (not stop_inclusive and node.sort_key == stop_key)):
+                return
+            yield (node.value, node.name) if with_names else node.value
+            node = node.left_child if reverse else node.right_child
+            while node is not None:
+                stack.append(node)
+                node = node.right_child if reverse else node.left_child
+
+    def as_list(self):
+        return list(self.irange())
+
+
+class ConcurrentBinaryTree(PersistentBinaryTree):
+    """ PersistentBinaryTree Shared Between Reader Threads And Writer Threads
+    A write publishes its new version with a single attribute store, so readers never lock and an iterator keeps
+    walking the version it started on. Writers are serialised by a lock.
+    """
+    def __init__(self, iterable=None, key=None):
+        PersistentBinaryTree.__init__(self, iterable, key)
+        self.lock = threading.Lock()
+
+    def insert(self, value, name=None):
+        sort_key = value if self.key is None else self.key(value)
+        with self.lock:
+            self.root = self.inserted(self.root, value, name, sort_key)
+
+    def remove(self, value, name=None):
+        sort_key = value if self.key is None else self.key(value)
+        with self.lock:
+            self.root = self.removed(self.root, sort_key, name)
+
+
+def shard_worker(connection, key):
+    """ Serve One Shard Of A ShardedBinaryTree, Replying (True, result) Or (False, error) To Each (command, args)
+    """
+    tree = BinaryTree(key=key)
+    while True:
+        command, args = connection.recv()
+        if command == "close":
+            connection.close()
+            return
+        try:
+            if command == "load":
+                tree = BinaryTree(args, key=key)
+                result = len(tree)
+            elif command == "insert_many":
+                tree.insert_many(args)
+                result = len(tree)
+            elif command == "remove_many":
+                tree.remove_many(args)
+                result = len(tree)
+            elif command == "find_many":
+                result = [tree.find(value) is not None for value in args]
+            elif command == "range":
+                low, high, inclusive = args
+                result = list(tree.irange(low, high, inclusive))
+            elif command == "count":
+                low, high = args
+                result = max(0, (len(tree) if high is None else tree.count_below(high, True)) -
+                             (0 if low is None else tree.count_below(low, False)))
+            elif command == "select_many":
+                result = [tree.select(index) for index in args]
+            elif command == "extract":
+                # keep [low, high), hand back everything else
+                low, high = args
+                moved = []
+                if low is not None:
+                    less, tree = tree.split(low)
+                    moved.extend(less.as_list(1))
+                if high is not None:
+                    tree, greater = tree.split(high)
+                    moved.extend(greater.as_list(1))
+                result = moved
+            elif command == "len":
+                result = len(tree)
+            else:
+                raise ValueError("unknown command " + repr(command))
+        except Exception as error:
+            connection.send((False, "%s: %s" % (type(error).__name__, error)))
+        else:
+            connection.send((True, result))
+
+
+class ShardedBinaryTree(object):
+    """ Keys Range-Partitioned Across Worker Processes, Each Holding A BinaryTree, To Use More Than One Core
+    Shard i holds the keys from bounds[i - 1] up to, but excluding, bounds[i]; the bounds come from a sample of
+    the loaded values. A request is scattered as one message per shard it touches, then the replies are gathered.
+    Values, and key if given, must be picklable; names are not supported. Call close() to stop the workers
+    """
+    SAMPLE_PER_SHARD = 100  # values sampled per shard when choosing bounds
+
+    def __init__(self, iterable=None, workers=4, key=None):
+        self.key = key
+        self.bounds = []  # workers - 1 values, ascending
+        self.bound_keys = []
+        self.hits = [0] * workers  # values or ranges routed to each shard since the last rebalance
+        self.connections = []
+        self.processes = []
+        for _ in range(workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shard_worker, args=(worker_connection, key))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        if iterable is not None:
+            self.load(iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(("close", None))
+            process.join()
+            connection.close()
+        self.connections = []
+        self.processes = []
+
+    def sort_key(self, value):
+        return value if self.key is None else self.key(value)
+
+    def set_bounds(self, bounds):
+        self.bounds = bounds
+        self.bound_keys = [self.sort_key(bound) for bound in bounds]
+
+    def shard_of(self, value):
+        return bisect.bisect_right(self.bound_keys, self.sort_key(value))
+
+    def shard_bounds(self, shard):
+        """ Return (low, high) Values Of shard's Range, None For An Open End
+        """
+        return (self.bounds[shard - 1] if shard > 0 else None,
+                self.bounds[shard] if shard < len(self.bounds) else None)
+
+    def scatter(self, command, shard_args):
+        """ Send command To Each Shard Whose Entry In shard_args Is Not None, Then Gather {shard: result}
+        Every reply is read before a failure is raised, so none is left to be mistaken for a later call's
+        """
+        sent = []
+        for shard, args in enumerate(shard_args):
+            if args is not None:
+                self.connections[shard].send((command, args))
+                sent.append(shard)
+        results = {}
+        failures = []
+        for shard in sent:
+            ok, result = self.connections[shard].recv()
+            if ok:
+                results[shard] = result
+            else:
+                failures.append("shard %d failed: %s" % (shard, result))
+        if failures:
+            raise RuntimeError("; ".join(failures))
+        return results
+
+    def partition(self, values):
+        """ Return One List Per Shard Of The values It Owns, Counting Them As Hits
+        """
+        parts = [[] for _ in self.connections]
+        bound_keys = self.bound_keys
+        for value in values:
+            parts[bisect.bisect_right(bound_keys, self.sort_key(value))].append(value)
+        for shard in range(len(parts)):
+            self.hits[shard] += len(parts[shard])
+        return parts
+
+    def load(self, iterable):
+        """ Replace The Contents, Choosing Bounds From A Sample And Building Every Shard In Parallel
+        """
+        values = list(iterable)
+        sample = random.sample(values, min(len(values), self.SAMPLE_PER_SHARD * len(self.connections)))
+        sample.sort(key=self.key)
+        self.set_bounds([sample[len(sample) * i // len(self.connections)] for i in range(1, len(self.connections))]
+                        if sample else [])
+        self.scatter("load", self.partition(values))
+
+    def insert(self, value):
+        self.insert_many([value])
+
+    def insert_many(self, values):
+        self.scatter("insert_many", [part or None for part in self.partition(values)])
+
+    def remove(self, value):
+        self.remove_many([value])
+
+    def remove_many(self, values):
+        self.scatter("remove_many", [part or None for part in self.partition(values)])
+
+    def find_many(self, values):
+        """ Return Whether Each Of values Is Stored, Asking Every Shard Involved Once
+        """
+        values = list(values)
+        shards = [self.shard_of(value) for value in values]
+        parts = self.partition(values)
+        results = self.scatter("find_many", [part or None for part in parts])
+        answers = dict((shard, iter(result)) for shard, result in results.items())
+        return [next(answers[shard]) for shard in shards]
+
+    def __contains__(self, value):
+        return self.find_many([value])[0]
+
+    def __len__(self):
+        return sum(self.scatter("len", [()] * len(self.connections)).values())
+
+    def touched(self, low, high):
+        """ Return The Shards Whose Ranges Meet [low, high]
+        """
+        first = 0 if low is None else self.shard_of(low)
+        last = len(self.connections) - 1 if high is None else self.shard_of(high)
+        return range(first, last + 1)
+
+    def irange(self, low=None, high=None, inclusive=(True, True)):
+        """ Return An Iterator Over The Values With Keys Between low And high, Gathered From The Shards In Order
+        """
+        shard_args = [None] * len(self.connections)
+        for shard in self.touched(low, high):
+            shard_args[shard] = (low, high, inclusive)
+            self.hits[shard] += 1
+        results = self.scatter("range", shard_args)
+        return itertools.chain.from_iterable(results[shard] for shard in sorted(results))
+
+    def count_range(self, low=None, high=None):
+        """ Return Number Of Values With low <= Key <= high
+        """
+        shard_args = [None] * len(self.connections)
+        for shard in self.touched(low, high):
+            shard_args[shard] = (low, high)
+        return sum(self.scatter("count", shard_args).values())
+
+    def rebalance(self, by_load=False, tolerance=1.5):
+        """ Move Bounds So Shards Hold Equal Numbers Of Values (Or, by_load, See Equal Traffic Since Last Time)
+        Only acts, returning True, when the largest shard's weight exceeds tolerance times the mean
+        New bounds are read off the shards' order statistics, then each shard hands back what it no longer owns
+        """
+        sizes = self.scatter("len", [()] * len(self.connections))
+        sizes = [sizes[shard] for shard in range(len(self.connections))]
+        weights = [hits if size else 0 for hits, size in zip(self.hits, sizes)] if by_load else sizes
+        total = float(sum(weights))
+        if total == 0 or max(weights) <= tolerance * total / len(weights):
+            return False
+        # the value at each cut, assuming weight is spread evenly over a shard's values
+        positions = [[] for _ in sizes]
+        cumulative = 0
+        shard = 0
+        for cut in range(1, len(sizes)):
+            target = total * cut / len(sizes)
+            while cumulative + weights[shard] < target:
+                cumulative += weights[shard]
+                shard += 1
+            positions[shard].append(min(sizes[shard] - 1, int((target - cumulative) / weights[shard] * sizes[shard])))
+        selected = self.scatter("select_many", [part or None for part in positions])
+        self.set_bounds([value for shard in sorted(selected) for value in selected[shard]])
+        moved = self.scatter("extract", [self.shard_bounds(shard) for shard in range(len(sizes))])
+        self.hits = [0] * len(sizes)
+        self.insert_many(itertools.chain.from_iterable(moved.values()))
+        self.hits = [0] * len(sizes)
+        return True
+
+
+def test():
+    def random_data_generator(count, max_val):
+        for n in xrange(count):
+            yield random.randint(0, max_val)
+
+    def sanity_check(tree=None, node=None):
+        if node is None and tree is not None:
+            node = tree.root
+            if tree.min_node() is not (tree.select_node(0) if len(tree) else None):
+                raise Exception("Cached min node is wrong!")
+            if tree.max_node() is not (tree.select_node(-1) if len(tree) else None):
+                raise Exception("Cached max node is wrong!")
+        if (node is None) or (node.is_leaf() and node.parent is None):
+            # trivial - no sanity check needed, as either the tree is empty or there is only one node in the tree
+            pass
+        else:
+            size = 1 + (node.left_child.size if node.left_child else 0) + (node.right_child.size if node.right_child else 0)
+            if node.size != size:
+                raise Exception("Invalid size for node " + str(node) + ": " + str(node.size) + " instead of " + str(size) + "!")
+            if node.height != node.max_child_height() + 1:
+                raise Exception("Invalid height for node " + str(node) + ": " + str(node.height) + " instead of " + str(node.max_child_height() + 1) + "!")
 
             bal_factor = node.weigh()
             #Test the balance factor
@@ -576,14 +3783,14 @@ def test():
             if node.left_child:
                 if not (node.left_child.parent == node):
                     raise Exception("Left child of node " + str(node) + " doesn't know who his father is!")
-                if not (node.left_child.key <= node.key):
+                if node.left_child > node:
                     raise Exception("Key of left child of node " + str(node) + " is greater than key of his parent!")
                 sanity_check(node=node.left_child)
 
             if node.right_child:
                 if not (node.right_child.parent == node):
                     raise Exception("Right child of node " + str(node) + " doesn't know who his father is!")
-                if not (node.right_child.key >= node.key):
+                if node.right_child < node:
                     raise Exception("Key of right child of node " + str(node) + " is less than key of his parent!")
                 sanity_check(node=node.right_child)
 
@@ -592,6 +3799,9 @@ def test():
     print("about to do sanity check 1")
     sanity_check(tree=a)
 
+    print("check that nodes are compact")
+    assert not hasattr(Node(1), "__dict__")
+
     print("check not empty tree creation")
     seq = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
     seq_copy = list(seq)
@@ -608,6 +3818,64 @@ def test():
     random.shuffle(seq)
     for x in seq:
         b.remove(x)
+    assert len(b) == 0
+
+    print("check that bulk loading sorts, drops duplicates and builds a balanced tree")
+    data = list(random_data_generator(1000, 500))
+    d = BinaryTree(data)
+    sanity_check(tree=d)
+    assert d.as_list(1) == sorted(set(data))
+    assert len(d) == len(set(data))
+    e = BinaryTree.from_sorted([1, 1, 2, 2, 3], ["a", "b", "a", "a", "c"])
+    sanity_check(tree=e)
+    assert e.as_list(1) == [[1, "a"], [1, "b"], [2, "a"], [3, "c"]]
+    assert len(e) == 4
+
+    print("check that a key function orders the tree")
+    f = BinaryTree([3, -1, 2, -5], key=abs)
+    sanity_check(tree=f)
+    assert f.as_list(1) == [-1, 2, 3, -5]
+    assert f.find(-2).value == 2
+    f.insert(1)
+    f.insert(4)
+    sanity_check(tree=f)
+    assert f.as_list(1) == [-1, 2, 3, 4, -5]
+
+    print("check that insert retracing touches an amortized constant number of nodes")
+    g = BinaryTree()
+    g.enable_stats()
+    for i in random_data_generator(20000, 25000):
+        g.insert(i)
+    sanity_check(tree=g)
+    stats = g.stats()
+    assert stats["retrace_steps"] < 4 * len(g)
+    assert stats["rebalances"] <= len(g) and stats["rebalances"] <= stats["rotations"] <= 2 * stats["rebalances"]
+    assert stats["operations"]["insert"]["calls"] == 20000
+    assert sum(stats["operations"]["insert"]["histogram"].values()) == 20000
+    assert stats["comparisons"] <= 20000 * (stats["height"] + 1) and stats["height"] < stats["height_bound"]
+    calls = []
+    g.enable_stats(hook=lambda operation, seconds, comparisons: calls.append((operation, comparisons)))
+    g.reset_stats()
+    g.remove(g.get_max())
+    assert [operation for operation, _ in calls] == ["remove"] and g.stats()["operations"]["find"]["calls"] == 0
+    assert calls[0][1] == g.stats()["comparisons"] > 0
+    g.reset_stats()
+    g.insert_many(range(30000, 30010))
+    g.finger_insert(30010)
+    stats = g.stats()
+    assert stats["operations"]["insert"]["calls"] == 11
+    assert stats["operations"]["insert"]["comparisons"] == stats["comparisons"] > 0
+    bag = MultisetTree([1, 2])
+    bag.enable_stats()
+    bag.add(2)
+    assert bag.stats()["comparisons"] == bag.stats()["operations"]["insert"]["comparisons"] > 0 and bag.stats()["operations"]["insert"]["calls"] == 1 and bag.count(2) == 2
+    g.disable_stats()
+    assert g.__class__ is BinaryTree and not hasattr(g, "comparisons")
+    sanity_check(tree=g)
+    h = BinaryTree([1, 2])
+    h.remove(1)
+    sanity_check(tree=h)
+    assert h.as_list(1) == [2]
 
     print("check that node deletion works")
     c = BinaryTree(random_data_generator(20000, 25000))
@@ -618,5 +3886,564 @@ def test():
     sanity_check(tree=c)
     assert (before_deletion >= after_deletion)
 
+    print("check rank, select, count_range and percentile against the sorted list")
+    ordered = c.as_list(1)
+    assert [c.rank(v) for v in ordered[::97]] == list(range(0, len(ordered), 97))
+    assert c.rank(-1) == 0 and c.rank(25001) == len(ordered)
+    assert [c[i] for i in range(0, len(ordered), 89)] == ordered[::89]
+    assert c[-1] == ordered[-1] and c[-len(ordered)] == ordered[0]
+    assert c[100:200] == ordered[100:200] and c[::-7] == ordered[::-7] and c[5:1] == []
+    assert c.count_range(1000, 2000) == len([v for v in ordered if 1000 <= v <= 2000])
+    assert c.percentile(0) == ordered[0] and c.percentile(100) == ordered[-1]
+    assert c.percentile(50) == ordered[int(math.ceil(len(ordered) / 2.0)) - 1]
+    assert e.rank(1, "b") == 1 and e.rank(2) == 2 and e.select(1) == [1, "b"]
+
+    print("check lazy iteration, irange and islice")
+    assert list(c) == ordered and list(reversed(c)) == ordered[::-1]
+    assert list(c.irange(1000, 2000)) == [v for v in ordered if 1000 <= v <= 2000]
+    assert list(c.irange(1000, 2000, (False, False), reverse=True)) == [v for v in ordered[::-1] if 1000 < v < 2000]
+    assert list(c.irange(high=ordered[3])) == ordered[:4]
+    assert list(c.irange(ordered[-3], inclusive=(False, True))) == ordered[-2:]
+    assert list(c.irange(2000, 1000)) == [] and list(c.irange(2000, 1000, reverse=True)) == []
+    assert list(c.irange(high=-1)) == [] and list(c.irange(25001, reverse=True)) == [] and list(BinaryTree()) == []
+    assert list(c.islice(10, 20)) == ordered[10:20] and list(c.islice(-5, reverse=True)) == ordered[-5:][::-1]
+    assert list(e.irange(2, with_names=True)) == [(2, "a"), (3, "c")]
+    assert ordered[0] in c and -1 not in c
+
+    print("check batched insert and remove, both sequentially and by rebuilding")
+    for batch_size in (50, 5000):
+        k = BinaryTree(random_data_generator(2000, 5000))
+        expected = set(k)
+        batch = list(random_data_generator(batch_size, 5000))
+        k.insert_many(batch)
+        sanity_check(tree=k)
+        expected.update(batch)
+        assert list(k) == sorted(expected) and len(k) == len(expected)
+        batch = list(random_data_generator(batch_size, 5000))
+        k.remove_many(batch)
+        sanity_check(tree=k)
+        expected.difference_update(batch)
+        assert list(k) == sorted(expected) and len(k) == len(expected)
+    m = BinaryTree.from_sorted([2], ["x"])
+    m.insert_many([3, 1, 3, 2], ["b", "a", "a", "x"])
+    sanity_check(tree=m)
+    assert list(m.irange(with_names=True)) == [(1, "a"), (2, "x"), (3, "a"), (3, "b")]
+
+    print("check split, join and set operations")
+    for pivot in (ordered[len(ordered) // 3], -1, 25001):
+        n = BinaryTree(ordered)
+        less, greater = n.split(pivot)
+        sanity_check(tree=less)
+        sanity_check(tree=greater)
+        assert list(less) == [v for v in ordered if v < pivot] and len(greater) == len([v for v in ordered if v >= pivot])
+        assert len(n) == 0 and n.root is None
+        n = BinaryTree.join(less, greater)
+        sanity_check(tree=n)
+        assert list(n) == ordered and len(n) == len(ordered) and len(less) == 0
+    n = BinaryTree.join(BinaryTree(range(5)), BinaryTree(range(5, 1000)))
+    sanity_check(tree=n)
+    assert list(n) == list(range(1000))
+    try:
+        BinaryTree.join(BinaryTree([1, 5]), BinaryTree([3]))
+        raise Exception("join of overlapping trees should fail")
+    except ValueError:
+        pass
+    first, second = set(random_data_generator(3000, 5000)), set(random_data_generator(300, 5000))
+    for operation, expected in (("union", first | second), ("intersection", first & second), ("difference", first - second)):
+        n = getattr(BinaryTree(first), operation)(BinaryTree(second))
+        sanity_check(tree=n)
+        assert list(n) == sorted(expected) and len(n) == len(expected)
+    assert list(BinaryTree(second).difference(BinaryTree(first))) == sorted(second - first)
+
+    print("check cursors and finger inserts")
+    p = BinaryTree()
+    for i in range(0, 2000, 2):
+        p.finger_insert(i)
+    for i in range(1997, 0, -4):
+        p.finger_insert(i)
+    sanity_check(tree=p)
+    expected = sorted(set(range(0, 2000, 2)) | set(range(1997, 0, -4)))
+    assert list(p) == expected
+    cursor = p.cursor(1001)
+    assert cursor.value == 1001 and cursor.next() and cursor.value == 1002 and cursor.prev() and cursor.prev()
+    assert cursor.value == 1000
+    cursor.remove()
+    assert cursor.value == 1001 and 1000 not in p
+    cursor.insert_before(1000.5)
+    cursor.insert_after(1000.75)
+    assert cursor.value == 1000.75 and list(p.irange(1000, 1001)) == [1000.5, 1000.75, 1001]
+    try:
+        cursor.insert_after(5)
+        raise Exception("insert_after out of order should fail")
+    except ValueError:
+        pass
+    cursor.seek_last()
+    cursor.insert_after(5000)
+    cursor.insert(-5)
+    assert not cursor.prev() and not cursor.valid
+    cursor.seek_first()
+    while cursor.valid:
+        cursor.remove()
+    sanity_check(tree=p)
+    assert len(p) == 0 and p.min_node() is None
+
+    print("check saving and loading snapshots, mapped and not")
+    path = tempfile.mktemp()
+    try:
+        BinaryTree(ordered).save(path)
+        q = BinaryTree.load(path)
+        assert q.snapshot is not None and len(q) == len(ordered) and list(q) == ordered and q[::-3] == ordered[::-3]
+        assert ordered[9] in q and -1 not in q and q[7] == ordered[7] and q[-1] == ordered[-1]
+        assert q.rank(ordered[100]) == 100 and q.count_range(1000, 2000) == c.count_range(1000, 2000)
+        assert list(q.irange(1000, 2000, reverse=True)) == list(c.irange(1000, 2000, reverse=True))
+        assert q.percentile(99) == c.percentile(99) and q.get_max() == ordered[-1] and list(q.islice(5, 9)) == ordered[5:9]
+        built = BinaryTree.load(path, mmap=False)
+        assert [q.as_list(i) for i in range(4)] + [q.height()] == [built.as_list(i) for i in range(4)] + [built.height()]
+        for probe in (ordered[0] - 1, ordered[0], ordered[300], ordered[300] + 1, ordered[-1], ordered[-1] + 1):
+            assert [q.floor(probe), q.ceiling(probe), q.lower(probe), q.higher(probe), q.nearest(probe)] == \
+                [built.floor(probe), built.ceiling(probe), built.lower(probe), built.higher(probe), built.nearest(probe)]
+            assert q.k_nearest(probe, 5) == built.k_nearest(probe, 5)
+        assert q.find(ordered[7]).value == q.select_node(7).value == ordered[7] and q.find(-1) is None
+        held = q.find(ordered[60])
+        assert q.snapshot is not None
+        q.remove_node(q.find(ordered[50]))
+        q.insert_beside(held, ordered[60] + 0.5)
+        sanity_check(tree=q)
+        assert q.snapshot is None and len(q) == len(ordered) and ordered[50] not in q and ordered[60] + 0.5 in q
+        for bad in ([2 ** 63, 2 ** 63 + 1], [0.5, 2 ** 60]):
+            try:
+                BinaryTree(bad).save(path)
+                assert False, "values that do not round-trip must raise"
+            except ValueError:
+                pass
+        try:
+            TreeMap.load(path)
+            assert False, "mapped subclass loads must raise"
+        except TypeError:
+            pass
+        q = BinaryTree.load(path)
+        q.insert(-1)
+        assert q.snapshot is None and q[0] == -1
+        sanity_check(tree=q)
+        e.save(path)
+        q = BinaryTree.load(path)
+        assert 1 not in q and q.rank(2, "a") == 2 and q[1] == [1, "b"] and q.find(1, "b") is not None
+        assert list(q.irange(with_names=True)) == list(e.irange(with_names=True))
+        q = BinaryTree.load(path, mmap=False)
+        sanity_check(tree=q)
+        assert q.as_list(1) == e.as_list(1)
+        BinaryTree([0.5, 2]).save(path)
+        assert list(BinaryTree.load(path)) == [0.5, 2.0]
+    finally:
+        os.remove(path)
+
+    print("check the priority queue operations against heapq")
+    pq = BinaryTree()
+    heap = []
+    for i in random.sample(range(100000), 3000):
+        if i % 5 == 0 and heap:
+            assert pq.pop_min() == heapq.heappop(heap)
+        elif i % 7 == 0 and heap:
+            assert pq.replace(i) == heapq.heapreplace(heap, i)
+        elif i % 11 == 0:
+            assert pq.pushpop(i) == heapq.heappushpop(heap, i)
+        else:
+            pq.insert(i)
+            heapq.heappush(heap, i)
+        assert not heap or pq.peek_min() == heap[0] == pq.get_min()
+        assert not heap or pq.peek_max() == max(heap) == pq.get_max()
+    sanity_check(tree=pq)
+    assert pq.pop_max() == max(heap)
+    while len(pq):
+        pq.pop_max()
+    for method in (pq.peek_min, pq.pop_min, pq.pop_max, lambda: pq.replace(1)):
+        try:
+            method()
+            assert False
+        except IndexError:
+            pass
+    assert pq.get_min() is None and pq.pushpop(5) == 5 and len(pq) == 0
+    bag = MultisetTree([2, 2, 3])
+    assert [bag.pop_min(), bag.pop_min(), bag.pop_min()] == [2, 2, 3] and len(bag) == 0
+
+    print("check floor, ceiling, lower, higher and nearest against the sorted list")
+    nt = BinaryTree(ordered[::3])
+    keys = ordered[::3]
+    for probe in [keys[0] - 1, keys[0], keys[5], keys[5] + 1, keys[-1], keys[-1] + 1, (keys[7] + keys[8]) / 2.0]:
+        assert nt.floor(probe) == max([v for v in keys if v <= probe] or [None])
+        assert nt.lower(probe) == max([v for v in keys if v < probe] or [None])
+        assert nt.ceiling(probe) == ([v for v in keys if v >= probe] or [None])[0]
+        assert nt.higher(probe) == ([v for v in keys if v > probe] or [None])[0]
+        by_distance = sorted(keys, key=lambda v: (abs(v - probe), v))
+        assert nt.nearest(probe) == by_distance[0] and nt.k_nearest(probe, 9) == by_distance[:9]
+    assert nt.k_nearest(keys[3], len(keys) + 5) == sorted(keys, key=lambda v: (abs(v - keys[3]), v))
+    assert BinaryTree().nearest(1) is None and BinaryTree().floor(1) is None and BinaryTree().k_nearest(1, 3) == []
+
+    print("check the tree map against a dict")
+    m = TreeMap([(3, "c"), (1, "a"), (2, "b"), (1, "z")])
+    assert list(m.items()) == [(1, "z"), (2, "b"), (3, "c")] and m[1] == "z" and 4 not in m
+    expected = dict(m.items())
+    for i in random_data_generator(2000, 500):
+        m[i] = expected[i] = i * 2
+        if i % 3 == 0:
+            assert m.pop(i) == expected.pop(i)
+        assert m.setdefault(i + 1, "new") == expected.setdefault(i + 1, "new")
+    sanity_check(tree=m)
+    assert list(m.items()) == sorted(expected.items()) and len(m) == len(expected)
+    assert list(m.keys()) == sorted(expected) and list(m.values()) == [expected[k] for k in sorted(expected)]
+    view = m.items(100, 200, (False, True))
+    assert list(view) == [(k, expected[k]) for k in sorted(expected) if 100 < k <= 200] and len(view) == len(list(view))
+    assert view[1:3] == list(view)[1:3] and view[-1] == list(view)[-1] and list(reversed(view)) == list(view)[::-1]
+    assert (150, expected.get(150, 0)) in view or 150 not in expected
+    assert m.get(-5, "missing") == "missing" and m.pop(-5, None) is None
+    m.insert(-7, "seven")
+    m.insert_many({-8: "eight", -7: "again"})
+    assert m[-7] == "again" and m[-8] == "eight"
+    del m[-7], m[-8]
+    try:
+        m.insert(-9)
+        assert False
+    except TypeError:
+        assert -9 not in m
+    del m[sorted(expected)[0]]
+    assert m.popitem() == (sorted(expected)[-1], expected[sorted(expected)[-1]])
+    assert m.popitem(last=False)[0] == sorted(expected)[1]
+    sanity_check(tree=m)
+    try:
+        m[-5]
+        assert False
+    except KeyError:
+        pass
+    assert not hasattr(MapNode(1), "__dict__")
+
+    print("check the multiset against a sorted list")
+    def check_totals(node):
+        if node is None:
+            return 0
+        total = node.count + check_totals(node.left_child) + check_totals(node.right_child)
+        assert node.total == total
+        return total
+
+    repeats = list(random_data_generator(3000, 200))
+    ms = MultisetTree(repeats[:1000])
+    ms.insert_many(repeats[1000:2000])
+    for i in repeats[2000:]:
+        ms.add(i)
+    expected = sorted(repeats)
+    for i in repeats[:500]:
+        ms.discard(i)
+        expected.remove(i)
+    ms.add(-1, 3)
+    ms.discard(-1, 2)
+    expected.insert(0, -1)
+    sanity_check(tree=ms)
+    check_totals(ms.root)
+    assert list(ms) == expected and list(reversed(ms)) == expected[::-1] and len(ms) == len(expected)
+    assert ms.element_count == len(set(expected)) and ms.count(expected[-1]) == expected.count(expected[-1])
+    assert list(ms.items()) == [(v, expected.count(v)) for v in sorted(set(expected))]
+    for target in (expected[0] - 3, expected[len(expected) // 2], expected[-1] + 2):
+        assert ms.k_nearest(target, 25) == sorted(expected, key=lambda v: (abs(v - target), v))[:25]
+    for value in (-1, 0, 50, 199, 500):
+        assert ms.rank(value) == len([v for v in expected if v < value])
+    assert ms.count_range(20, 40) == len([v for v in expected if 20 <= v <= 40])
+    assert [ms[i] for i in (0, 7, len(expected) // 2, -1)] == [expected[i] for i in (0, 7, len(expected) // 2, -1)]
+    assert ms[10:300:7] == expected[10:300:7] and ms.percentile(50) == expected[int(math.ceil(len(expected) / 2.0)) - 1]
+    assert list(ms.islice(5, 400)) == expected[5:400] and list(ms.islice(5, 400, reverse=True)) == expected[5:400][::-1]
+    assert list(ms.irange(20, 40, (False, True))) == [v for v in expected if 20 < v <= 40]
+    ms.remove(expected[-1])
+    assert expected[-1] not in ms
+    check_totals(ms.root)
+    for bad in ((5, 0), (1, -5)):
+        for method in (ms.add, ms.discard):
+            try:
+                method(*bad)
+                assert False, "non-positive occurrences must raise"
+            except ValueError:
+                pass
+    first, second = repeats[:400], repeats[300:1000]
+    for operation, combine in (("union", lambda a, b: a + b), ("intersection", lambda a, b: a & b),
+                               ("difference", lambda a, b: a - b)):
+        combined = getattr(MultisetTree(first), operation)(MultisetTree(second))
+        sanity_check(tree=combined)
+        check_totals(combined.root)
+        assert list(combined) == sorted(combine(collections.Counter(first), collections.Counter(second)).elements())
+
+    print("check the btree engine against the avl engine")
+    halves = [v + 0.5 for v in ordered[:50]]
+    avl = BinaryTree(halves)
+    wide = BinaryTree(halves, engine="btree")
+    named = BinaryTree()
+    named.insert(1, "a")
+    named.insert(1, "b")
+    named.remove(1, "a")
+    assert named.as_list(1) == [[1, "b"]]
+    assert isinstance(wide, BTree) and not isinstance(wide, BinaryTree) and wide.as_list(1) == avl.as_list(1)
+    assert not any(hasattr(wide, name) for name in ("rank", "enable_stats", "cursor", "split", "save"))
+    assert wide.peek_min() == avl.peek_min() and wide.peek_max() == avl.peek_max()
+    wide.LOAD = 4  # small leaves, so splits and merges happen
+    for i in random_data_generator(3000, 400):
+        if i % 4 == 0:
+            avl.remove(i)
+            wide.remove(i)
+        else:
+            avl.insert(i, None if i % 3 else "n")
+            wide.insert(i, None if i % 3 else "n")
+    assert wide.as_list(3) == avl.as_list(1) and len(wide) == len(avl)
+    assert list(reversed(wide)) == list(reversed(avl)) and wide.get_min() == avl.get_min() and wide.get_max() == avl.get_max()
+    assert all(len(leaf) <= 8 for leaf in wide.leaves) and wide.maxes == [leaf[-1] for leaf in wide.leaves]
+    for low, high, inclusive in ((10, 50, (True, True)), (10, 50, (False, False)), (-5, 3, (True, False)), (399, 999, (True, True))):
+        for reverse in (False, True):
+            assert list(wide.irange(low, high, inclusive, reverse, True)) == list(avl.irange(low, high, inclusive, reverse, True))
+    assert wide.find(halves[0]) is not None and wide.find(halves[0] + 0.25) is None
+    assert all((wide.find(v, "n") is None) == (avl.find(v, "n") is None) for v in range(0, 400, 3))
+    assert BinaryTree(engine="btree").get_min() is None and list(BinaryTree(engine="btree")) == []
+
+    print("check range aggregates, including an order-sensitive one")
+    def check_aggregates(node):
+        if node is None:
+            return ""
+        text = check_aggregates(node.left_child) + str(node.value) + check_aggregates(node.right_child)
+        assert node.aggregate == text
+        return text
+
+    sums = BinaryTree(ordered[:200], aggregate="sum")
+    words = BinaryTree(ordered[:200], aggregate=(lambda a, b: a + b, "", str))
+    largest = BinaryTree(ordered[:200], key=lambda v: -v, aggregate="max")
+    for i in random_data_generator(2000, 25000):
+        for tree in (sums, words, largest):
+            if i % 3 == 0:
+                tree.remove(i)
+            else:
+                tree.insert(i)
+    for tree in (sums, words, largest):
+        sanity_check(tree=tree)
+    check_aggregates(words.root)
+    expected = sums.as_list(1)
+    assert sums.aggregate_range() == sum(expected) and largest.aggregate_range() == max(expected)
+    for low, high in ((expected[3], expected[90]), (expected[50], None), (None, expected[-7]), (-1, -1), (10 ** 6, None)):
+        for inclusive in ((True, True), (False, True), (True, False), (False, False)):
+            inside = [v for v in expected if (low is None or v > low or (inclusive[0] and v == low)) and
+                      (high is None or v < high or (inclusive[1] and v == high))]
+            assert sums.aggregate_range(low, high, inclusive) == sum(inside)
+            assert words.aggregate_range(low, high, inclusive) == "".join(str(v) for v in inside)
+    assert largest.aggregate_range(expected[40], expected[30]) == expected[40]
+    assert BinaryTree(aggregate="count").aggregate_range() == 0 and isinstance(sums, AggregateTree)
+    low_half, high_half = BinaryTree([1, 5, 3, 9, 7], aggregate="max").split(5)
+    high_half.insert(6)
+    high_half.insert(8)
+    assert high_half.aggregate_range() == 9 and low_half.aggregate_range() == 3
+    words.enable_stats()
+    head, tail = words.split(expected[100])
+    extra = tail.empty_like()
+    extra.insert(-1)
+    joined = BinaryTree.join(tail.union(extra), tail.empty_like())
+    for tree in (head, tail, joined):
+        check_aggregates(tree.root)
+    assert head.__class__ is AggregateTree and head.aggregate_range() == "".join(str(v) for v in expected[:100])
+    sums, largest, plain = BinaryTree([1, 2], aggregate="sum"), BinaryTree([3, 4], aggregate="max"), BinaryTree([5])
+    for combine in (lambda: BinaryTree.join(sums, largest), lambda: sums.union(plain), lambda: plain.intersection(sums),
+                    lambda: largest.difference(BinaryTree([3], aggregate="min")), lambda: sums.union(BinaryTree(engine="btree"))):
+        try:
+            combine()
+            assert False, "trees with different nodes or aggregates must not combine"
+        except ValueError:
+            pass
+    assert sums.as_list(1) == [1, 2] and largest.as_list(1) == [3, 4] and plain.as_list(1) == [5]
+    assert BinaryTree.join(sums, BinaryTree([7], aggregate="sum")).aggregate_range() == 10
+
+    print("check interval overlap queries against a scan")
+    intervals = [(start, start + random.randint(0, 300)) for start in random_data_generator(2000, 10000)]
+    it = IntervalTree(intervals[:1000])
+    for interval in intervals[1000:]:
+        it.insert(interval)
+    for interval in intervals[:300]:
+        it.remove(interval)
+    sanity_check(tree=it)
+    stored = sorted(set(intervals) - set(intervals[:300]))
+    assert it.as_list(1) == stored
+    for low, high in ((5000, 5100), (0, 0), (-10, -1), (9999, 20000), (7000, 7000)):
+        assert list(it.overlapping(low, high)) == [iv for iv in stored if iv[0] <= high and iv[1] >= low]
+    assert list(it.stabbing(2500)) == [iv for iv in stored if iv[0] <= 2500 <= iv[1]]
+    early, late = it.split((5000, 0))
+    assert isinstance(late, IntervalTree) and list(late.stabbing(5050)) == [iv for iv in stored if 5000 <= iv[0] <= 5050 <= iv[1]]
+    late = late.union(IntervalTree([(6000, 9000)])).difference(IntervalTree(stored[-5:]))
+    merged = IntervalTree.join(early, late)
+    sanity_check(tree=merged)
+    expected = sorted(set(stored[:-5]) | set([(6000, 9000)]))
+    assert list(merged.overlapping(6500, 6600)) == [iv for iv in expected if iv[0] <= 6600 and iv[1] >= 6500]
+    assert list(IntervalTree.from_sorted(stored).stabbing(700)) == [iv for iv in stored if iv[0] <= 700 <= iv[1]]
+
+    print("check the sharded tree against a single tree")
+    with ShardedBinaryTree(ordered, workers=3) as st:
+        assert len(st) == len(ordered) and list(st.irange()) == ordered
+        st.insert_many(range(-50, 0))
+        st.remove_many(ordered[:100])
+        single = BinaryTree(list(range(-50, 0)) + ordered[100:])
+        assert list(st.irange()) == single.as_list(1) and len(st) == len(single)
+        assert list(st.irange(ordered[200], ordered[900], (False, True))) == list(single.irange(ordered[200], ordered[900], (False, True)))
+        assert st.count_range(-10, ordered[500]) == single.count_range(-10, ordered[500])
+        assert st.find_many([ordered[0], ordered[150], -3, 10 ** 6]) == [False, True, True, False] and -50 in st
+        # pile new values into the last shard, then even the shards out
+        st.insert_many(range(10 ** 6, 10 ** 6 + 20000))
+        single.insert_many(range(10 ** 6, 10 ** 6 + 20000))
+        assert st.rebalance() and list(st.irange()) == single.as_list(1)
+        sizes = st.scatter("len", [()] * 3)
+        assert max(sizes.values()) < 1.5 * len(single) / 3 and not st.rebalance()
+        # a hot first shard gets split across all three
+        st.find_many([-1] * 3000)
+        assert st.rebalance(by_load=True) and st.shard_of(single.select(len(single) // 2)) == 2
+        assert list(st.irange()) == single.as_list(1)
+        try:
+            list(st.irange(None, 999, None))
+            assert False, "a bad range must raise"
+        except RuntimeError:
+            pass
+        assert len(st) == len(single) and st.count_range(-10, 500) == single.count_range(-10, 500)
+
+    print("check top-k trees against sorting the whole stream")
+    stream = [random.randint(0, 5000) for _ in range(20000)]
+    top = BinaryTree(stream[:100], capacity=300)
+    assert isinstance(top, TopKTree) and top.threshold() is None
+    top.insert_many(stream[100:])
+    sanity_check(tree=top)
+    best = sorted(set(stream))[-300:]
+    assert list(top.ranked()) == best[::-1] and len(top) == 300 and top.threshold() == best[0]
+    assert top.insert(best[0]) is False and top.insert(5001) is True and top.get_max() == 5001 and len(top) == 300
+    bottom = BinaryTree(key=lambda v: -v, capacity=50, keep="smallest")
+    bottom.insert_many(stream, names=range(len(stream)))
+    sanity_check(tree=bottom)
+    expected = sorted(enumerate(stream), key=lambda pair: (-pair[1], pair[0]))[:50]
+    assert [(value, name) for value, name in bottom.ranked(with_names=True)] == [(v, i) for i, v in expected]
+    small = BinaryTree(range(10), capacity=5)
+    small.finger_insert(20)
+    small.finger_insert(21)
+    small.cursor(20).insert_before(19)
+    small.insert_beside(small.find(21), 22)
+    sanity_check(tree=small)
+    assert small.as_list(1) == [9, 19, 20, 21, 22]
+    low_part, high_part = small.split(20)
+    assert high_part.capacity == 5 and list(high_part.union(BinaryTree(range(30, 40), capacity=5))) == list(range(35, 40))
+    assert list(BinaryTree.join(low_part, BinaryTree([50, 51], capacity=5))) == [9, 19, 50, 51]
+    full = BinaryTree([9, 19, 20, 21, 22], capacity=5)
+    cursor = full.cursor(19)
+    assert full.finger_insert(5) is None and full.insert_near(full.find(9), 9) is None
+    assert full.insert_beside(full.find(9), 8, after=False) is None
+    cursor.insert_before(9)
+    assert cursor.current() is full.find(19) and len(full) == 5
+    cursor.insert_after(19.5)
+    assert cursor.current() is full.find(19.5) and full.as_list(1) == [19, 19.5, 20, 21, 22]
+    sanity_check(tree=full)
+    sorted_best = TopKTree.from_sorted(range(1000), capacity=3, keep="smallest")
+    assert list(sorted_best) == [0, 1, 2] and list(TopKTree.from_sorted(range(1000), capacity=3)) == [997, 998, 999]
+    path = tempfile.mktemp()
+    try:
+        BinaryTree(range(100)).save(path)
+        assert list(TopKTree.load(path, mmap=False, capacity=4).ranked()) == [99, 98, 97, 96]
+    finally:
+        os.remove(path)
+
+    print("check sliding windows against a deque")
+    stream = list(random_data_generator(5000, 300))
+    sw = SlidingWindowTree(window_size=500)
+    recent = collections.deque(maxlen=500)
+    for value in stream[:2000]:
+        sw.add(value)
+        recent.append(value)
+    sw.extend(stream[2000:], batch=64)
+    recent.extend(stream[2000:])
+    sanity_check(tree=sw)
+    expected = sorted(recent)
+    assert list(sw) == expected and len(sw) == 500 and sw.get_min() == expected[0] and sw.get_max() == expected[-1]
+    assert sw.median() == expected[249] and sw.quantile(0.99) == expected[494] and sw.rank(150) == bisect.bisect_left(expected, 150)
+    recent = list(recent)
+    for value in (recent[0], recent[-1], -1):
+        assert (value in sw) == (value in recent) and (sw.find(value) is not None) == (value in recent)
+        sw.remove(value)
+        if value in recent:
+            recent.remove(value)
+    sw.remove_many(recent[:3])
+    del recent[:3]
+    recent.remove(sw.pop_min())
+    recent.remove(sw.pop_max())
+    pushed = sw.get_min() + 1
+    recent.remove(sw.pushpop(pushed))
+    recent.append(pushed)
+    cursor = sw.cursor(recent[0])
+    cursor.remove()
+    recent.remove(recent[0])
+    assert len(sw.arrivals) == len(sw) == len(recent) and sorted(sw) == sorted(recent)
+    for value in stream[:600]:
+        sw.add(value)
+    sanity_check(tree=sw)
+    assert list(sw) == sorted(stream[100:600]) and len(sw.arrivals) == 500
+    sw.insert(stream[0])
+    assert list(sw) == sorted(stream[101:600] + stream[:1])
+    for blocked in (lambda: sw.split(150), lambda: sw.union(BinaryTree([1])), lambda: BinaryTree([1]).union(sw),
+                    lambda: sw.insert_beside(sw.min_node(), 0), lambda: sw.finger_insert(0)):
+        try:
+            blocked()
+            assert False, "a sliding window must not be split, combined or inserted into outside add()"
+        except (TypeError, ValueError):
+            pass
+    assert len(sw) == 500 and len(sw.arrivals) == 500
+    tw = SlidingWindowTree(window_seconds=10)
+    tw.extend(((t * 0.5, stream[t]) for t in range(1000)), timestamped=True, batch=7)
+    assert sorted(tw) == sorted(stream[980:1000])
+    tw.expire(now=10000)
+    assert len(tw) == 0 and tw.get_min() is None
+    try:
+        import asyncio
+    except ImportError:
+        asyncio = None
+    if asyncio is not None and hasattr(asyncio, "ensure_future"):
+        class Source(object):
+            def __init__(self, values):
+                self.values = iter(values)
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                for value in self.values:
+                    return asyncio.sleep(0, result=value)
+                raise StopAsyncIteration
+
+        aw = SlidingWindowTree(window_size=100)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(asyncio.ensure_future(aw.afeed(Source(stream), batch=33), loop=loop))
+        loop.close()
+        assert list(aw) == sorted(stream[-100:])
+
+    print("check persistent snapshots")
+    p = PersistentBinaryTree(ordered[:100], key=lambda v: -v)
+    before = p.snapshot()
+    p.remove(ordered[0])
+    p.insert(-1)
+    assert before.as_list() == ordered[:100][::-1] and len(before) == 100
+    assert p.as_list() == ordered[1:100][::-1] + [-1] and p.snapshot().as_list() == p.as_list()
+    before.insert(-2)
+    assert -2 not in p and before.get_max() == -2
+
+    print("check the concurrent tree, including iterators that outlive writes")
+    r = ConcurrentBinaryTree(ordered)
+    assert list(r) == ordered and list(reversed(r)) == ordered[::-1] and len(r) == len(ordered)
+    iterator = r.irange(1000, 2000)
+    for value in ordered[:len(ordered) // 2]:
+        r.remove(value)
+    r.insert(1500.5)
+    assert list(iterator) == [v for v in ordered if 1000 <= v <= 2000]
+    expected = sorted(ordered[len(ordered) // 2:] + [1500.5])
+    assert list(r) == expected and len(r) == len(expected) and 1500.5 in r and ordered[0] not in r
+    assert r.rank(expected[10]) == 10 and r[-1] == expected[-1] and r.get_min() == expected[0]
+    assert list(r.irange(expected[5], expected[9], (False, True), reverse=True)) == expected[6:10][::-1]
+    assert r.height() < 1.44 * math.log(len(r) + 2, 2) - 1
+    workers = [threading.Thread(target=lambda offset=offset: [r.insert(offset + 0.25 * i) for i in range(200)])
+               for offset in (30000, 40000)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(r) == len(expected) + 400
+
     print("check that an AVL tree's height is strictly less than 1.44*log2(N+2)-1 (there N is number of elements)")
     assert (c.height() < 1.44 * math.log(after_deletion + 2, 2) - 1)